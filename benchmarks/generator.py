@@ -0,0 +1,205 @@
+"""
+Benchmark the generator on a synthetic source tree
+
+Usage: python benchmarks/generator.py [options]
+
+Creates a tree with a number of module directories with C files and
+headers and an hb.py file each.  Modules export their sources, chained
+to the sources of the previous module, so that resolving the last
+export of a chain resolves all of it.  Some modules have a generated
+header.  The top hb.py file compiles all modules with the gcc rule.
+
+Times, and peak memory from tracemalloc, are reported for:
+
+    scan: finding the hb.py files of all module directories
+    pathset: globbing all C files
+    evaluate: running all hb.py files, including the gcc rule
+    gcc: time spent in the gcc rule function (part of evaluate)
+    write_ninja: writing the ninja file
+
+Results are written as JSON, with the git commit, so that they can be
+compared with the results of another commit (--compare).  A large tree,
+with 10k directories and 200k C files:
+
+    python benchmarks/generator.py --modules 10000 --files 20
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from os.path import abspath, dirname
+
+import hb
+
+
+_gcc = f"{dirname(abspath(hb.__file__))}/rules/_gcc.py"
+
+_module_hbpy = """
+def build(hb):
+    hb.export("src", "*.c", "*.h"{chain})
+"""
+
+_top_hbpy = """
+def build(hb):
+    @hb.rule("touch $out")
+    def gen(dst):
+        hb.build(gen, dst)
+
+    for i in range({modules}):
+        if i % {generated} == 0:
+            gen(f"mods/m{{i}}/gen{{i}}.h")
+        hb.gcc(f"mods/m{{i}}/*.c")
+    for i in range({chain} - 1, {modules}, {chain}):
+        hb.pathset(f"mods/m{{i}}/@src")
+"""
+
+
+def make_tree(top: str, modules: int, files: int, chain: int, generated):
+    """Create synthetic source tree in directory top"""
+    open(f"{top}/.hbroot", "w").close()
+    with open(f"{top}/hb.py", "w") as fh:
+        fh.write(
+            _top_hbpy.format(
+                modules=modules, chain=chain, generated=generated
+            )
+        )
+    for i in range(modules):
+        directory = f"{top}/mods/m{i}"
+        os.makedirs(directory)
+        link = f', "../m{i - 1}/@src"' if i % chain else ""
+        with open(f"{directory}/hb.py", "w") as fh:
+            fh.write(_module_hbpy.format(chain=link))
+        for j in range(files):
+            with open(f"{directory}/f{i}_{j}.c", "w") as fh:
+                fh.write(f'#include "m{i}.h"\nint f{i}_{j};\n')
+        open(f"{directory}/m{i}.h", "w").close()
+
+
+def _evaluated(top: str, profile: bool = False):
+    context = hb.context(top, profile=profile)
+    hb.read.load_and_run(context, _gcc)
+    hb.read.load_and_run(context, f"{top}/hb.py")
+    return context
+
+
+def _phases(top: str, modules: int):
+    """Return dict with (setup, run) functions per phase. run() takes
+    the value returned by setup(), and returns the measured time."""
+
+    def timed(fn):
+        def run(arg):
+            start = time.perf_counter()
+            fn(arg)
+            return time.perf_counter() - start
+
+        return run
+
+    def gcc_time(_):
+        context = _evaluated(top, profile=True)
+        return context.profile.rules["gcc"].total
+
+    dirs = [f"{top}/mods/m{i}" for i in range(modules)]
+    return {
+        "scan": (lambda: dirs, timed(lambda d: hb.read.scan(d))),
+        "pathset": (
+            lambda: hb.context(top),
+            timed(lambda c: c.pathset("mods/*/*.c")),
+        ),
+        "evaluate": (lambda: top, timed(_evaluated)),
+        "gcc": (lambda: None, gcc_time),
+        "write_ninja": (
+            lambda: _evaluated(top),
+            timed(lambda c: c.write_ninja(io.StringIO())),
+        ),
+    }
+
+
+def run(top: str, modules: int, repeat: int, memory: bool):
+    results = {}
+    for name, (setup, fn) in _phases(top, modules).items():
+        times = [fn(setup()) for _ in range(repeat)]
+        result = {"time": min(times)}
+        if memory:
+            arg = setup()
+            tracemalloc.start()
+            fn(arg)
+            result["peak"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results[name] = result
+        print(f"{name:12} {result['time']:9.4f}s", end="", flush=True)
+        if memory:
+            print(f" {result['peak'] / 1e6:9.1f}MB", end="")
+        print()
+    return results
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=dirname(abspath(__file__)),
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except FileNotFoundError:
+        return ""
+
+
+def compare(results, base):
+    print(f"Compared with {base.get('commit', '')[:12]}:")
+    for name, result in results.items():
+        old = base["results"].get(name)
+        if not old:
+            continue
+        line = f"{name:12} {result['time'] / old['time']:6.2f}x time"
+        if "peak" in result and "peak" in old:
+            line += f" {result['peak'] / old['peak']:6.2f}x memory"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--modules", type=int, default=200)
+    parser.add_argument("--files", type=int, default=20, help="per module")
+    parser.add_argument("--chain", type=int, default=10, help="export chain")
+    parser.add_argument(
+        "--generated", type=int, default=10, help="modules per generated .h"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true")
+    parser.add_argument("--output", default="", help="JSON results file")
+    parser.add_argument("--compare", default="", help="JSON results file")
+    args = parser.parse_args()
+    params = {
+        "modules": args.modules,
+        "files": args.files,
+        "chain": args.chain,
+        "generated": args.generated,
+    }
+    with tempfile.TemporaryDirectory() as top:
+        make_tree(top, args.modules, args.files, args.chain, args.generated)
+        results = run(top, args.modules, args.repeat, not args.no_memory)
+    data = {
+        "commit": _commit(),
+        "python": sys.version.split()[0],
+        "machine": platform.machine(),
+        "params": params,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(data, fh, indent=1)
+    if args.compare:
+        with open(args.compare) as fh:
+            compare(results, json.load(fh))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Compare ninja file writers on a synthetic graph
+
+Usage: python benchmarks/ninja_writer.py [builds]
+"""
+
+import sys
+import tempfile
+import time
+
+import ninja
+from hb import _ninja
+
+
+def _graph(n):
+    for i in range(n):
+        d = f"src/module{i % 500}/sub{i % 7}"
+        yield (
+            f"{d}/file{i}.o",
+            f"{d}/file{i}.c",
+            [f"{d}/file{i}.h", f"include/common{i % 13}.h"],
+            {"opts": "-O2 -g -Wall -Wextra"},
+        )
+
+
+def _run(writer_class, graph, path):
+    start = time.perf_counter()
+    fh = open(path, "w")
+    writer = writer_class(fh)
+    writer.variable("builddir", ".hb")
+    writer.rule("cc", "gcc -MD -MF $out.d ${opts} -c $in -o $out")
+    for dst, src, deps, vars in graph:
+        writer.build(dst, "cc", src, deps, None, vars)
+    writer.close()
+    elapsed = time.perf_counter() - start
+    with open(path) as fh:
+        return elapsed, fh.read()
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    graph = list(_graph(n))
+    with tempfile.TemporaryDirectory() as tmp:
+        old, old_text = _run(ninja.Writer, graph, f"{tmp}/old.ninja")
+        new, new_text = _run(_ninja.Writer, graph, f"{tmp}/new.ninja")
+    assert old_text == new_text
+    print(f"{n} builds, {len(new_text)} bytes")
+    print(f"ninja.Writer:  {old:.3f}s")
+    print(f"_ninja.Writer: {new:.3f}s ({old / new:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
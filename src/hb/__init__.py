@@ -1,14 +1,18 @@
 from . import _path as path
 from . import _read as read
 from . import _rule as rule
+from . import _profile
+from . import _ninja
 
 
 class Context(rule._Context):
 
     pathset = path.pathset
+    listfile = path.listfile
     export = path.export
     canonical = path.canonical
     stat = path.stat
+    prefetch = path.prefetch
     isdir = path.isdir
     exists = path.exists
     newest = path.newest
@@ -19,6 +23,8 @@ class Context(rule._Context):
     build = rule.build
     rules = rule.rules
     write_ninja = rule.write_ninja
+    write_split = rule.write_split
+    generate = rule.generate
     rule = rule.rule
 
     def paths(self, pathset):
@@ -30,11 +36,29 @@ class Context(rule._Context):
     def relative(self, frompath, pathset):
         return path.relative(frompath, pathset)
 
+    def update_file(self, path, text):
+        return _ninja.update_file(path, text)
 
-def context(cwdpath: str = ""):
+
+FsCache = path.FsCache
+
+
+def context(
+    cwdpath: str = "",
+    gitindex: bool = False,
+    cache: FsCache = None,
+    profile: bool = False,
+):
     """Create context base on given path, or current directory
-    if not given, Return rule context"""
-    return path.context(cwdpath, Context)
+    if not given, Return rule context.
+    If gitindex is True, files are enumerated from the git index.
+    If a shared file system cache is given, it is used by the context.
+    If profile is True, context.profile records where time is spent,
+    see hb._profile."""
+    ctx = path.context(cwdpath, Context, gitindex, cache)
+    if profile:
+        ctx.profile = _profile.Profile()
+    return ctx
 
 
 __all__ = [
@@ -42,4 +66,5 @@ __all__ = [
     "read",
     "rule",
     "Context",
+    "FsCache",
 ]
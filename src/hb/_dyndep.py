@@ -0,0 +1,112 @@
+"""
+Ninja dyndep files for generated C headers
+
+Usage: python _dyndep.py DDFILE DEPFILE OBJECT GENERATED -- COMMAND
+
+COMMAND is a compiler invocation that writes the make style dependencies
+of one source file to stdout, including headers that do not exist yet
+(gcc -MM -MG).  The dependencies that are among the generated headers,
+listed one per line in the file GENERATED, are written to DDFILE, a ninja
+dyndep file that makes them implicit inputs of OBJECT.  The other
+dependencies are written to DEPFILE, so that the scan is redone when the
+source file or any header it includes changes.  Generated headers are
+left out, or the scan would be redone once they have been generated,
+also when they were generated while the scan was running.
+
+Missing headers are reported by the compiler as written in the #include
+directive, and are matched against the generated headers by path suffix.
+Generated headers included from headers that are not generated yet are
+not found, the compiler depfile of OBJECT covers them in later builds.
+"""
+
+import os
+import subprocess
+import sys
+from os.path import exists, normpath
+from typing import Dict, Iterable, List, Optional
+
+
+# This file is run as a script, by path, and does not import from hb
+
+
+def _escape_path(word: str) -> str:
+    return word.replace("$ ", "$$ ").replace(" ", "$ ").replace(":", "$:")
+
+
+def _write_file(path: str, text: str):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as fh:
+        fh.write(text)
+    os.replace(tmp, path)
+
+
+def parse_deps(text: str) -> List[str]:
+    """Return the prerequisites of make style rules"""
+    deps = []
+    text = text.replace("\\\n", " ")
+    for line in text.splitlines():
+        _, colon, prereqs = line.partition(": ")
+        if not colon:
+            continue
+        word = ""
+        for part in prereqs.split(" "):
+            if part.endswith("\\"):
+                word += part[:-1] + " "
+                continue
+            word += part
+            if word:
+                deps.append(word)
+            word = ""
+    return deps
+
+
+def generated(deps: Iterable[str], headers: Iterable[str]) -> List[str]:
+    """Return the generated headers that are among deps.
+    A dependency matches a header with the same path, or with a path
+    ending with /dependency."""
+    names: Dict[str, List[str]] = {}
+    for header in headers:
+        names.setdefault(header.rpartition("/")[2], []).append(header)
+    found = {}
+    for dep in deps:
+        dep = normpath(dep)
+        for header in names.get(dep.rpartition("/")[2], ()):
+            if header == dep or header.endswith(f"/{dep}"):
+                found[header] = True
+                break
+    return list(found)
+
+
+def write(ddfile: str, obj: str, headers: List[str]):
+    """Write ninja dyndep file with headers as implicit inputs of obj"""
+    line = f"build {_escape_path(obj)}: dyndep"
+    if headers:
+        line += " | " + " ".join(map(_escape_path, headers))
+    _write_file(ddfile, f"ninja_dyndep_version = 1\n{line}\n")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = sys.argv[1:] if argv is None else argv
+    if "--" not in args or args.index("--") != 4:
+        print(__doc__.split("\n\n")[1], file=sys.stderr)
+        return 2
+    sep = args.index("--")
+    ddfile, depfile, obj, genh = args[:sep]
+    with open(genh) as fh:
+        headers = fh.read().splitlines()
+    result = subprocess.run(args[sep + 1 :], stdout=subprocess.PIPE)
+    if result.returncode:
+        return result.returncode
+    deps = parse_deps(result.stdout.decode())
+    found = generated(deps, headers)
+    write(ddfile, obj, found)
+    inputs = dict.fromkeys(
+        normpath(d) for d in deps if exists(d) and not generated([d], found)
+    )
+    inputs = " ".join(d.replace(" ", "\\ ") for d in inputs)
+    _write_file(depfile, f"{ddfile}: {inputs}\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
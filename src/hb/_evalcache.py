@@ -0,0 +1,389 @@
+"""
+Incremental evaluation cache
+
+Records what each hb.py file produced when its build() function was
+called (exported path sets, builds and context attributes), together
+with what it consumed (named path sets from other hb.py files, directory
+listings used for globbing, list files, stats of probed paths, imported
+modules, the rules it used and the context attributes set by other hb.py
+files).  A later
+evaluation can then replay the recorded outputs instead of executing the
+hb.py file, as long as the file and everything it consumed are
+unchanged.  Reads of context attributes are not tracked, all attributes
+visible when the file is run are recorded as consumed.
+
+hb.py files that define rules, or load other hb.py files that do, and
+hb.py files that leave other state on the context that cannot be
+recorded, are always executed.
+
+Consumed path sets are checked without running other hb.py files.  The
+hb.py file exporting a path set that is not defined yet is replayed
+first, if it can be, otherwise the consuming file is executed.
+
+Path sets of builds and exports are stored once in a table shared by all
+entries, and referred to by index.  Path sets composed of other path
+sets are stored as the indexes of their parts.  Replayed builds share
+the path set objects created from the table, like builds that were
+executed.
+"""
+
+import hashlib
+import json
+import os
+from dataclasses import dataclass, field, fields
+from os.path import dirname
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from ._path import listdir
+from ._pathset import PathSet
+from . import _manifest, _rule
+
+
+_VERSION = 4
+_Entry = Dict[str, Any]
+_simple = (str, int, float, bool, type(None))
+
+
+def _file_digest(path: str) -> str:
+    try:
+        with open(path, "rb") as fh:
+            return hashlib.sha1(fh.read()).hexdigest()
+    except FileNotFoundError:
+        return ""
+
+
+def _pathset_digest(pset: Iterable[str]) -> str:
+    if isinstance(pset, PathSet):
+        pset = pset.walk()
+    return hashlib.sha1("\n".join(pset).encode()).hexdigest()
+
+
+def _key(item: Any) -> Tuple[Any, ...]:
+    """Return key of path set table item, paths or part indexes"""
+    if isinstance(item, dict):
+        return tuple(item["parts"])
+    return tuple(item)
+
+
+def _attrs(context) -> Dict[str, Any]:
+    """Return the context attributes set by hb.py files"""
+    fixed = {f.name for f in fields(context)}
+    rules = context._rules
+    return {
+        name: value
+        for name, value in vars(context).items()
+        if name not in fixed and name not in rules
+    }
+
+
+def _attrs_digest(attrs: Dict[str, Any]) -> Optional[str]:
+    """Return digest of attributes, None if some value is not simple"""
+    if not all(isinstance(v, _simple) for v in attrs.values()):
+        return None
+    text = json.dumps(sorted(attrs.items()))
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+@dataclass
+class _Frame:
+    path: str
+    digest: str
+    attrs: Dict[str, Any]
+    visible: Optional[str]
+    consumed: Dict[str, str] = field(default_factory=dict)
+    listed: Dict[str, str] = field(default_factory=dict)
+    read: Dict[str, str] = field(default_factory=dict)
+    probed: Dict[str, Optional[List[int]]] = field(default_factory=dict)
+    imported: Dict[str, str] = field(default_factory=dict)
+    rules: Dict[str, str] = field(default_factory=dict)
+    exports: Dict[str, int] = field(default_factory=dict)
+    builds: List[List[Any]] = field(default_factory=list)
+    cacheable: bool = True
+
+
+@dataclass
+class EvalCache:
+    entries: Dict[str, _Entry] = field(default_factory=dict)
+    # Paths, or {"parts": indexes} for composed path sets
+    pathsets: List[Any] = field(default_factory=list)
+    replayed: int = 0
+    executed: int = 0
+    _frames: List[Optional[_Frame]] = field(default_factory=list)
+    _digests: Dict[str, str] = field(default_factory=dict)
+    # Indexes in pathsets by path set object id (holding on to the path
+    # set so the id is not reused), and by path set key
+    _ids: Dict[int, Tuple[PathSet, int]] = field(default_factory=dict)
+    _keys: Optional[Dict[Tuple[Any, ...], int]] = None
+    _psets: Dict[int, PathSet] = field(default_factory=dict)
+
+    def _digest(self, path: str) -> str:
+        digest = self._digests.get(path)
+        if digest is None:
+            digest = self._digests[path] = _file_digest(path)
+        return digest
+
+    def _top(self) -> Optional[_Frame]:
+        return self._frames[-1] if self._frames else None
+
+    def _index(self, pset: PathSet) -> int:
+        """Return index of path set in the table, add it if new"""
+        known = self._ids.get(id(pset))
+        if known is not None:
+            return known[1]
+        if self._keys is None:
+            self._keys = {
+                _key(item): index for index, item in enumerate(self.pathsets)
+            }
+        parts = pset.parts()
+        if parts:
+            item: Any = {"parts": [self._index(p) for p in parts]}
+        else:
+            item = list(pset)
+        key = _key(item)
+        index = self._keys.get(key)
+        if index is None:
+            index = self._keys[key] = len(self.pathsets)
+            self.pathsets.append(item)
+        self._ids[id(pset)] = (pset, index)
+        return index
+
+    def _pathset(self, index: int) -> PathSet:
+        """Return path set in the table, created once per index"""
+        pset = self._psets.get(index)
+        if pset is None:
+            item = self.pathsets[index]
+            if isinstance(item, dict):
+                parts = [self._pathset(i) for i in item["parts"]]
+                pset = PathSet.concat(parts)
+            else:
+                pset = PathSet(item)
+            self._psets[index] = pset
+            self._ids[id(pset)] = (pset, index)
+        return pset
+
+    def _export(self, context, name: str) -> Optional[PathSet]:
+        """Return named path set, replaying the hb.py file exporting it
+        if it is not loaded yet.  Return None if that file would have
+        to be executed."""
+        pset = context.named_pathsets.get(name)
+        hb_path = f"{dirname(name)}/hb.py"
+        if pset is None and hb_path not in context._loaded:
+            context._loaded[hb_path] = True
+            if self.replay(context, hb_path):
+                pset = context.named_pathsets.get(name)
+            else:
+                del context._loaded[hb_path]
+        return pset
+
+    def replay(self, context, hb_path: str) -> bool:
+        """Replay recorded outputs of hb.py file, if they are still valid.
+        Return True if replayed, False if the file must be executed."""
+        entry = self.entries.get(hb_path)
+        if not entry or entry["digest"] != self._digest(hb_path):
+            return False
+        if _attrs_digest(_attrs(context)) != entry["visible"]:
+            return False
+        for path, digest in entry["imported"].items():
+            if self._digest(path) != digest:
+                return False
+        for name, digest in entry["consumed"].items():
+            pset = self._export(context, name)
+            if pset is None or _pathset_digest(pset) != digest:
+                return False
+        # List directories outside of the current frame, they are not
+        # consumed by the hb.py file being evaluated.
+        self._frames.append(None)
+        try:
+            for directory, digest in entry["listed"].items():
+                if _pathset_digest(listdir(context, directory)) != digest:
+                    return False
+            for path, digest in entry["read"].items():
+                if self._digest(path) != digest:
+                    return False
+            for path, signature in entry["probed"].items():
+                if _manifest._stat(path) != signature:
+                    return False
+        finally:
+            self._frames.pop()
+        rules = context._rules
+        for name, digest in entry["rules"].items():
+            rule = rules.get(name)
+            if rule is None or self._digest(rule.origin) != digest:
+                return False
+        db = context.named_pathsets
+        for name, index in entry["exports"].items():
+            fullname = f"{dirname(hb_path)}/@{name}"
+            if fullname in db:
+                raise ValueError(f"Named pathset {fullname} already defined")
+            db[fullname] = self._pathset(index)
+        inputs = []
+        for name, *indexes, vars in entry["builds"]:
+            dst, src, deps, oodeps = map(self._pathset, indexes)
+            rules[name].used = True
+            context.targets.update(dict.fromkeys(dst, True))
+            context._builds.append(
+                _rule._Build(
+                    name, dst, src, deps, oodeps, vars, dirname(hb_path)
+                )
+            )
+            inputs += (src, deps, oodeps)
+        for name, value in entry["attrs"].items():
+            setattr(context, name, value)
+        context._imported.update(dict.fromkeys(entry["imported"], True))
+        for name in ("read", "probed"):
+            context._consulted.update(dict.fromkeys(entry[name], True))
+        self.replayed += 1
+        _rule._scan(context, inputs)
+        return True
+
+    def begin(self, context, hb_path: str):
+        """Start recording outputs of hb.py file"""
+        attrs = _attrs(context)
+        frame = _Frame(
+            hb_path, self._digest(hb_path), attrs, _attrs_digest(attrs)
+        )
+        frame.cacheable = frame.visible is not None
+        self._frames.append(frame)
+
+    def end(self, context, hb_path: str):
+        """Stop recording outputs of hb.py file, and store them if
+        they can be replayed"""
+        frame = self._frames.pop()
+        assert frame and frame.path == hb_path
+        self.executed += 1
+        if not frame.cacheable:
+            self.entries.pop(hb_path, None)
+            return
+        attrs = {}
+        for name, value in _attrs(context).items():
+            if frame.attrs.get(name, attrs) is value:
+                continue
+            if not isinstance(value, _simple):
+                self.entries.pop(hb_path, None)
+                return
+            attrs[name] = value
+        self.entries[hb_path] = {
+            "digest": frame.digest,
+            "consumed": frame.consumed,
+            "listed": frame.listed,
+            "read": frame.read,
+            "probed": frame.probed,
+            "imported": frame.imported,
+            "visible": frame.visible,
+            "rules": frame.rules,
+            "exports": frame.exports,
+            "builds": frame.builds,
+            "attrs": attrs,
+        }
+
+    def consumed(self, name: str, pset: PathSet):
+        """Record consumed named path set"""
+        frame = self._top()
+        if frame is None:
+            return
+        directory, _, export = name.rpartition("/@")
+        if directory == dirname(frame.path) and export in frame.exports:
+            return
+        frame.consumed[name] = _pathset_digest(pset)
+
+    def listed(self, directory: str, names: Iterable[str]):
+        """Record consumed directory listing"""
+        frame = self._top()
+        if frame is not None and directory not in frame.listed:
+            frame.listed[directory] = _pathset_digest(names)
+
+    def read(self, path: str):
+        """Record consumed file, e.g. a list file"""
+        frame = self._top()
+        if frame is not None:
+            frame.read[path] = self._digest(path)
+
+    def probed(self, path: str):
+        """Record stats of path probed with stat(), isdir() or exists()"""
+        frame = self._top()
+        if frame is not None and path not in frame.probed:
+            frame.probed[path] = _manifest._stat(path)
+
+    def imported(self, paths: Iterable[str]):
+        """Record source files of imported modules"""
+        frame = self._top()
+        if frame is not None:
+            for path in paths:
+                frame.imported[path] = self._digest(path)
+
+    def exported(self, name: str, pset: PathSet):
+        """Record exported named path set"""
+        frame = self._top()
+        if frame is not None:
+            frame.exports[name] = self._index(pset)
+
+    def defined(self, rule):
+        """Record rule definition, hb.py files defining rules, and the
+        hb.py files loading them, are not cached"""
+        for frame in self._frames:
+            if frame is not None:
+                frame.cacheable = False
+
+    def built(self, rule, build):
+        """Record build"""
+        frame = self._top()
+        if frame is None:
+            return
+        if not all(isinstance(v, _simple) for v in build.vars.values()):
+            frame.cacheable = False
+        frame.rules[rule.name] = self._digest(rule.origin)
+        frame.builds.append(
+            [
+                build.rule,
+                self._index(build.dst),
+                self._index(build.src),
+                self._index(build.deps),
+                self._index(build.oodeps),
+                dict(build.vars),
+            ]
+        )
+
+
+def load(path: str) -> EvalCache:
+    """Load evaluation cache from file, return empty cache if the file
+    does not exist or is from another version"""
+    try:
+        with open(path) as fh:
+            data = json.load(fh)
+    except (FileNotFoundError, ValueError):
+        return EvalCache()
+    if data.get("version") != _VERSION:
+        return EvalCache()
+    return EvalCache(data["entries"], data["pathsets"])
+
+
+def save(cache: EvalCache, path: str):
+    """Save evaluation cache to file, with only the path sets that
+    are used by its entries"""
+    pathsets: List[Any] = []
+    renumbered: Dict[int, int] = {}
+
+    def index(old: int) -> int:
+        new = renumbered.get(old)
+        if new is None:
+            item = cache.pathsets[old]
+            if isinstance(item, dict):
+                item = {"parts": [index(i) for i in item["parts"]]}
+            new = renumbered[old] = len(pathsets)
+            pathsets.append(item)
+        return new
+
+    entries = {}
+    for hb_path, entry in cache.entries.items():
+        builds = [
+            [name, *map(index, indexes), vars]
+            for name, *indexes, vars in entry["builds"]
+        ]
+        exports = {name: index(i) for name, i in entry["exports"].items()}
+        entries[hb_path] = {**entry, "builds": builds, "exports": exports}
+    data = {"version": _VERSION, "pathsets": pathsets, "entries": entries}
+    os.makedirs(dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as fh:
+        json.dump(data, fh)
+    os.replace(tmp, path)
@@ -0,0 +1,224 @@
+"""
+File enumeration from the git index
+
+Reads the git index file once and answers file existence, stat and
+directory listing queries for paths in the work tree from a sorted
+in-memory path table, instead of accessing the file system.
+Only tracked files are visible, untracked files do not exist.
+"""
+
+import os
+import struct
+from bisect import bisect_left
+from os.path import dirname, isdir, isfile
+from stat import S_IFDIR, S_IFMT, S_ISDIR, S_ISLNK
+from typing import Dict, List, Optional, Tuple
+
+
+_header = struct.Struct(">4sLL")
+_entry = struct.Struct(">LLLLLLLLLL20sH")
+_S_IFGITLINK = 0o160000
+_DIRMODE = S_IFDIR | 0o755
+# Extended flags
+_EXTENDED = 0x4000
+_SKIP_WORKTREE = 0x4000
+_INTENT_TO_ADD = 0x2000
+
+_Stat = Tuple[int, int, int, int]  # mode, size, mtime_ns, ctime_ns
+
+
+def find_worktree(path: str) -> Tuple[str, str]:
+    """Find top of git work tree and git directory, given a path in
+    the work tree.  Return (worktree, gitdir)."""
+    top = path
+    while True:
+        dotgit = f"{top}/.git"
+        if isdir(dotgit):
+            return top, dotgit
+        if isfile(dotgit):
+            with open(dotgit) as fh:
+                gitdir = fh.read().strip()
+            if gitdir.startswith("gitdir:"):
+                gitdir = gitdir[7:].strip()
+                if gitdir[0] != "/":
+                    gitdir = os.path.normpath(f"{top}/{gitdir}")
+                return top, gitdir
+        if top in ("/", ""):
+            raise FileNotFoundError(f"Cannot find git work tree for {path}")
+        top = dirname(top)
+
+
+def _varint(data: bytes, pos: int) -> Tuple[int, int]:
+    c = data[pos]
+    pos += 1
+    value = c & 127
+    while c & 128:
+        c = data[pos]
+        pos += 1
+        value = ((value + 1) << 7) | (c & 127)
+    return value, pos
+
+
+def read_index(filename: str) -> Dict[str, _Stat]:
+    """Read git index file.
+    Return dict with file stats (mode, size, mtime, ctime) keyed on
+    paths relative the work tree.
+    Files not checked out in the work tree are skipped.
+    """
+    with open(filename, "rb") as fh:
+        data = fh.read()
+    signature, version, count = _header.unpack_from(data)
+    if signature != b"DIRC" or version not in (2, 3, 4):
+        raise ValueError(f"Unsupported index file {filename}")
+    files = {}
+    pos = _header.size
+    name = b""
+    for _ in range(count):
+        start = pos
+        (
+            ctime,
+            ctime_ns,
+            mtime,
+            mtime_ns,
+            _,
+            _,
+            mode,
+            _,
+            _,
+            size,
+            _,
+            flags,
+        ) = _entry.unpack_from(data, pos)
+        pos += _entry.size
+        extended = 0
+        if flags & _EXTENDED:
+            (extended,) = struct.unpack_from(">H", data, pos)
+            pos += 2
+        if version == 4:
+            strip, pos = _varint(data, pos)
+            end = data.index(b"\0", pos)
+            name = name[: len(name) - strip] + data[pos:end]
+            pos = end + 1
+        else:
+            end = data.index(b"\0", pos)
+            name = data[pos:end]
+            pos = start + ((end - start + 8) & ~7)
+        if extended & (_SKIP_WORKTREE | _INTENT_TO_ADD):
+            continue
+        if S_IFMT(mode) == _S_IFGITLINK:
+            mode = _DIRMODE
+        files[name.decode()] = (
+            mode,
+            size,
+            mtime * 1000000000 + mtime_ns,
+            max(ctime * 1000000000 + ctime_ns, 1),
+        )
+    return files
+
+
+class _Entry:
+    """Directory entry from git index, with the os.DirEntry methods used
+    by hb"""
+
+    __slots__ = ("name", "path", "_stat")
+
+    def __init__(self, name: str, path: str, stat: os.stat_result):
+        self.name = name
+        self.path = path
+        self._stat = stat
+
+    def stat(self) -> os.stat_result:
+        return self._stat
+
+    def is_dir(self) -> bool:
+        return S_ISDIR(self._stat.st_mode)
+
+    def is_symlink(self) -> bool:
+        return S_ISLNK(self._stat.st_mode)
+
+
+def _stat_result(mode: int, size: int, mtime: int, ctime: int):
+    return os.stat_result(
+        (
+            mode,
+            0,
+            0,
+            1,
+            0,
+            0,
+            size,
+            mtime // 1000000000,
+            mtime // 1000000000,
+            ctime // 1000000000,
+            mtime / 1e9,
+            mtime / 1e9,
+            ctime / 1e9,
+            mtime,
+            mtime,
+            ctime,
+        )
+    )
+
+
+class GitIndex:
+    """Sorted table of absolute paths to tracked files in a git work
+    tree"""
+
+    def __init__(self, worktree: str, files: Dict[str, _Stat], filename=""):
+        self.worktree = worktree
+        self.filename = filename
+        self._prefix = f"{worktree}/" if worktree != "/" else "/"
+        self._files = {f"{self._prefix}{p}": s for p, s in files.items()}
+        self.paths: List[str] = sorted(self._files)
+        self._dirstat = _stat_result(_DIRMODE, 0, 0, 1)
+
+    def covers(self, path: str) -> bool:
+        """Return True if path is in the work tree"""
+        return path.startswith(self._prefix) or path == self.worktree
+
+    def _isdir(self, path: str) -> bool:
+        prefix = f"{path}/"
+        i = bisect_left(self.paths, prefix)
+        return i < len(self.paths) and self.paths[i].startswith(prefix)
+
+    def stat(self, path: str) -> Optional[os.stat_result]:
+        """Return stats recorded in the index for a file, or directory
+        stats if path is a directory with tracked files, or None if path
+        is not tracked"""
+        st = self._files.get(path)
+        if st is not None:
+            return _stat_result(*st)
+        if path == self.worktree or self._isdir(path):
+            return self._dirstat
+        return None
+
+    def listdir(self, directory: str) -> Dict[str, _Entry]:
+        """Return dict with entries in a directory, sorted by name.
+        Empty if the directory does not contain tracked files."""
+        prefix = f"{directory}/" if directory != "/" else "/"
+        start = len(prefix)
+        paths = self.paths
+        n = len(paths)
+        i = bisect_left(paths, prefix)
+        entries = {}
+        while i < n and paths[i].startswith(prefix):
+            path = paths[i]
+            slash = path.find("/", start)
+            if slash < 0:
+                stat = _stat_result(*self._files[path])
+                i += 1
+            else:
+                path = path[:slash]
+                stat = self._dirstat
+                # Skip rest of sub directory, "0" sorts right after "/"
+                i = bisect_left(paths, f"{path}0", i)
+            name = path[start:]
+            entries[name] = _Entry(name, path, stat)
+        return dict(sorted(entries.items()))
+
+
+def load(path: str) -> GitIndex:
+    """Load git index for the work tree containing path"""
+    worktree, gitdir = find_worktree(path)
+    filename = f"{gitdir}/index"
+    return GitIndex(worktree, read_index(filename), filename)
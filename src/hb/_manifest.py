@@ -0,0 +1,106 @@
+"""
+Generation manifest
+
+Records the stats of everything that was consulted when a ninja file
+was generated, so that later runs can tell if the ninja file is still
+valid without loading any hb.py files.
+"""
+
+import hashlib
+import json
+import os
+from functools import lru_cache
+from os.path import dirname
+from typing import Dict, Any, Iterable, Optional, List
+
+
+PathSet = Dict[str, bool]
+Context = Dict[str, Any]
+
+_VERSION = 2
+
+
+def _stat(path: str) -> Optional[List[int]]:
+    """Return the stat signature of a path, None if it does not exist"""
+    try:
+        st = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+@lru_cache(maxsize=None)
+def _hb_digest() -> str:
+    """Return digest of the source files of hb, which are not recorded
+    as inputs, so that a manifest is only valid for the same hb"""
+    sha1 = hashlib.sha1()
+    top = dirname(__file__)
+    for directory, dirs, names in os.walk(top):
+        dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+        for name in sorted(names):
+            if name.endswith(".py"):
+                path = f"{directory}/{name}"
+                sha1.update(path[len(top) :].encode())
+                with open(path, "rb") as fh:
+                    sha1.update(fh.read())
+    return sha1.hexdigest()
+
+
+def inputs(context: Context) -> PathSet:
+    """Return pathset with all paths consulted when evaluating the build
+    description: loaded hb.py files, source files of modules they
+    imported, listed directories, list files and probed paths.
+    Scanned directories are represented by the hb.py file that was looked
+    for, so that unrelated changes in the directory do not invalidate the
+    manifest."""
+    pset = {**context._loaded, **context._imported, **context._consulted}
+    for directory in context._scanned:
+        pset[f"{directory}/hb.py"] = True
+    return pset
+
+
+def write(
+    context: Context, manifest: str, outputs: Iterable[str], key: str = ""
+):
+    """Write manifest for ninja files generated from context, the
+    first output is the main ninja file.
+    The key is a string describing generation options, a manifest
+    is only valid for the same key, and the same hb source.
+    """
+    os.makedirs(dirname(manifest), exist_ok=True)
+    data = {
+        "version": _VERSION,
+        "key": key,
+        "hb": _hb_digest(),
+        "outputs": [[path, _stat(path)] for path in outputs],
+        "inputs": {path: _stat(path) for path in inputs(context)},
+    }
+    tmp = f"{manifest}.tmp"
+    with open(tmp, "w") as fh:
+        json.dump(data, fh)
+    os.replace(tmp, manifest)
+
+
+def up_to_date(manifest: str, ninja_file: str, key: str = "") -> bool:
+    """Return True if the ninja file recorded in the manifest, and the
+    other ninja files written with it, exist and are unmodified, and
+    none of the recorded inputs have changed"""
+    try:
+        with open(manifest) as fh:
+            data = json.load(fh)
+    except (FileNotFoundError, ValueError):
+        return False
+    if data.get("version") != _VERSION or data.get("key") != key:
+        return False
+    if data.get("hb") != _hb_digest():
+        return False
+    outputs = data["outputs"]
+    if outputs[0][0] != ninja_file:
+        return False
+    for path, signature in outputs:
+        if _stat(path) != signature:
+            return False
+    for path, signature in data["inputs"].items():
+        if _stat(path) != signature:
+            return False
+    return True
@@ -0,0 +1,273 @@
+"""
+Fast ninja file writer
+
+Produces the same output as ninja.Writer (ninja_syntax), but collects
+the output in a buffer that is written in large chunks, and only does
+line wrapping work for lines that are too long.
+"""
+
+import os
+import textwrap
+from contextlib import contextmanager
+from os.path import dirname, basename
+from typing import IO, Dict, Iterator, List, Optional, Tuple, Union
+
+
+_Paths = Optional[Union[str, List[str]]]
+_Vars = Optional[Union[List[Tuple[str, _Paths]], Dict[str, _Paths]]]
+
+_CHUNK_SIZE = 1 << 20
+
+
+def escape_path(word: str) -> str:
+    if " " not in word and ":" not in word:
+        return word
+    return word.replace("$ ", "$$ ").replace(" ", "$ ").replace(":", "$:")
+
+
+def _as_list(value: _Paths) -> List[str]:
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def _join(paths: Union[str, List[str]]) -> str:
+    """Join escaped paths, escaping only when needed"""
+    if isinstance(paths, str):
+        return escape_path(paths)
+    text = " ".join(paths)
+    if ":" in text or text.count(" ") >= len(paths):
+        text = " ".join(map(escape_path, paths))
+    return text
+
+
+def _count_dollars_before_index(s: str, i: int) -> int:
+    """Returns the number of '$' characters right in front of s[i]."""
+    dollar_count = 0
+    dollar_index = i - 1
+    while dollar_index > 0 and s[dollar_index] == "$":
+        dollar_count += 1
+        dollar_index -= 1
+    return dollar_count
+
+
+class Writer:
+    """Ninja file writer, with the same interface and output as
+    ninja.Writer.  Call flush() or close() when done."""
+
+    def __init__(self, output: IO[str], width: int = 78):
+        self.output = output
+        self.width = width
+        # Number of bytes written, UTF-8 encoded
+        self.written = 0
+        self._chunks: List[str] = []
+        self._size = 0
+
+    def _write(self, text: str):
+        self._chunks.append(text)
+        self._size += len(text)
+        if self._size >= _CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Write buffered output"""
+        if self._chunks:
+            text = "".join(self._chunks)
+            self.output.write(text)
+            self.written += len(text.encode())
+            self._chunks = []
+            self._size = 0
+
+    def close(self):
+        self.flush()
+        self.output.close()
+
+    def newline(self):
+        self._write("\n")
+
+    def comment(self, text: str):
+        for line in textwrap.wrap(
+            text,
+            self.width - 2,
+            break_long_words=False,
+            break_on_hyphens=False,
+        ):
+            self._write(f"# {line}\n")
+
+    def variable(self, key: str, value, indent: int = 0):
+        if value is None:
+            return
+        if isinstance(value, list):
+            value = " ".join(filter(None, value))
+        self._line(f"{key} = {value}", indent)
+
+    def pool(self, name: str, depth: int):
+        self._line(f"pool {name}")
+        self.variable("depth", depth, indent=1)
+
+    def rule(
+        self,
+        name: str,
+        command: str,
+        description: Optional[str] = None,
+        depfile: Optional[str] = None,
+        generator: bool = False,
+        pool: Optional[str] = None,
+        restat: bool = False,
+        rspfile: Optional[str] = None,
+        rspfile_content: Optional[str] = None,
+        deps: _Paths = None,
+    ):
+        self._line(f"rule {name}")
+        self.variable("command", command, indent=1)
+        if description:
+            self.variable("description", description, indent=1)
+        if depfile:
+            self.variable("depfile", depfile, indent=1)
+        if generator:
+            self.variable("generator", "1", indent=1)
+        if pool:
+            self.variable("pool", pool, indent=1)
+        if restat:
+            self.variable("restat", "1", indent=1)
+        if rspfile:
+            self.variable("rspfile", rspfile, indent=1)
+        if rspfile_content:
+            self.variable("rspfile_content", rspfile_content, indent=1)
+        if deps:
+            self.variable("deps", deps, indent=1)
+
+    def build(
+        self,
+        outputs: _Paths,
+        rule: str,
+        inputs: _Paths = None,
+        implicit: _Paths = None,
+        order_only: _Paths = None,
+        variables: _Vars = None,
+        implicit_outputs: _Paths = None,
+        pool: Optional[str] = None,
+        dyndep: Optional[str] = None,
+    ) -> List[str]:
+        outputs = _as_list(outputs)
+        text = f"build {_join(outputs)}"
+        if implicit_outputs:
+            text = f"{text} | {_join(implicit_outputs)}"
+        text = f"{text}: {rule}"
+        inputs = _as_list(inputs)
+        if inputs:
+            text = f"{text} {_join(inputs)}"
+        if implicit:
+            text = f"{text} | {_join(implicit)}"
+        if order_only:
+            text = f"{text} || {_join(order_only)}"
+        if len(text) <= self.width:
+            self._write(f"{text}\n")
+        else:
+            self._wrap(text, "", 0)
+        if pool is not None:
+            self._line(f"  pool = {pool}")
+        if dyndep is not None:
+            self._line(f"  dyndep = {dyndep}")
+        if variables:
+            if isinstance(variables, dict):
+                variables = variables.items()
+            for key, value in variables:
+                if value is None:
+                    continue
+                if isinstance(value, list):
+                    value = " ".join(filter(None, value))
+                text = f"{key} = {value}"
+                if len(text) + 2 <= self.width:
+                    self._write(f"  {text}\n")
+                else:
+                    self._wrap(text, "  ", 1)
+        return outputs
+
+    def include(self, path: str):
+        self._line(f"include {path}")
+
+    def subninja(self, path: str):
+        self._line(f"subninja {path}")
+
+    def default(self, paths: _Paths):
+        self._line(f"default {' '.join(_as_list(paths))}")
+
+    def _line(self, text: str, indent: int = 0):
+        """Write 'text' word-wrapped at self.width characters."""
+        leading_space = "  " * indent
+        if len(leading_space) + len(text) <= self.width:
+            self._write(f"{leading_space}{text}\n")
+            return
+        self._wrap(text, leading_space, indent)
+
+    def _wrap(self, text: str, leading_space: str, indent: int):
+        # Same algorithm as ninja_syntax, to get identical output.
+        # Without '$' in the text, all spaces are unescaped.
+        plain = "$" not in text
+        lines = []
+        width = self.width
+        while len(leading_space) + len(text) > width:
+            available_space = width - len(leading_space) - 2
+            if plain:
+                space = text.rfind(" ", 0, available_space)
+                if space < 0:
+                    space = text.find(" ", available_space)
+            else:
+                space = _find_space(text, available_space)
+            if space < 0:
+                break
+            lines.append(f"{leading_space}{text[:space]} $\n")
+            text = text[space + 1 :]
+            leading_space = "  " * (indent + 2)
+        lines.append(f"{leading_space}{text}\n")
+        self._write("".join(lines))
+
+
+def _find_space(text: str, available_space: int) -> int:
+    """Return index of the rightmost unescaped space before
+    available_space, or else the first one after, or -1"""
+    space = available_space
+    while True:
+        space = text.rfind(" ", 0, space)
+        if space < 0 or _count_dollars_before_index(text, space) % 2 == 0:
+            break
+    if space < 0:
+        space = available_space - 1
+        while True:
+            space = text.find(" ", space + 1)
+            if space < 0 or _count_dollars_before_index(text, space) % 2 == 0:
+                break
+    return space
+
+
+@contextmanager
+def atomic_open(path: str) -> Iterator[IO[str]]:
+    """Open file for writing via a temporary file in the same directory,
+    that replaces the file when successfully closed"""
+    tmp = f"{dirname(path) or '.'}/.{basename(path)}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w") as fh:
+            yield fh
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def update_file(path: str, text: str) -> bool:
+    """Write text to file, unless the file already has that content,
+    so that the file modification time is kept.  The directory of the
+    file is created if needed.
+    Return True if the file was written."""
+    try:
+        with open(path) as fh:
+            if fh.read() == text:
+                return False
+    except FileNotFoundError:
+        os.makedirs(dirname(path) or ".", exist_ok=True)
+    with atomic_open(path) as fh:
+        fh.write(text)
+    return True
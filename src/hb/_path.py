@@ -3,17 +3,22 @@ Cononical file paths with caching
 """
 
 from ._read import load_and_run
+from ._pathset import PathSet, intern
+from . import _gitindex
 
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+from functools import lru_cache
 from os.path import normpath, dirname, relpath
 from os import getcwd
 from stat import S_ISDIR
-from typing import Dict, Iterable, List, Tuple, Union, Any
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from typing import Any
 from dataclasses import dataclass, field
 
 
-PathSet = Dict[str, bool]
 AnyPath = Union[str, PathSet, Iterable[str], Iterable[Union[PathSet, str]]]
 Context = Dict[str, Any]
 
@@ -25,10 +30,56 @@ class _Context:
     anchor: str = ""
     hits: int = 0
     misses: int = 0
+    canon_hits: int = 0
+    canon_misses: int = 0
+    profile: Any = None
     named_pathsets: Dict[str, PathSet] = field(default_factory=dict)
     _dir_cache: Dict[str, str] = field(default_factory=dict)
+    _canon_cache: Dict[Tuple[str, str, str], str] = field(default_factory=dict)
     _stat_cache: Dict[str, os.stat_result] = field(default_factory=dict)
-    _loaded: PathSet = field(default_factory=dict)
+    _list_cache: Dict[str, Tuple[Any, ...]] = field(default_factory=dict)
+    _listing: Dict[str, Dict[str, os.DirEntry]] = field(default_factory=dict)
+    _consulted: Dict[str, bool] = field(default_factory=dict)
+    _loaded: Dict[str, bool] = field(default_factory=dict)
+    _imported: Dict[str, bool] = field(default_factory=dict)
+    _depth: int = 0
+    _bytecode: str = ""
+    _evalcache: Any = None
+    _index: Any = None
+
+
+@dataclass
+class FsCache:
+    """File system cache that can be shared by contexts created in the
+    same process.  Holds file stats, directory listings, root lookups,
+    canonical paths and list file contents.  Call invalidate() when the
+    file system has changed.
+    Contexts sharing a cache should use the same gitindex setting.
+    """
+
+    stats: Dict[str, os.stat_result] = field(default_factory=dict)
+    dirs: Dict[str, str] = field(default_factory=dict)
+    listings: Dict[str, Dict[str, os.DirEntry]] = field(default_factory=dict)
+    roots: Dict[str, str] = field(default_factory=dict)
+    canonical: Dict[Tuple[str, str, str], str] = field(default_factory=dict)
+    lists: Dict[str, Tuple[Any, ...]] = field(default_factory=dict)
+
+    def invalidate(self, path: str = "") -> None:
+        """Invalidate cached data for a path, including the listing of
+        the directory containing it, or all cached data if no path is
+        given."""
+        if not path:
+            self.stats.clear()
+            self.dirs.clear()
+            self.listings.clear()
+            self.roots.clear()
+            return
+        self.stats.pop(path, None)
+        self.dirs.pop(path, None)
+        self.listings.pop(path, None)
+        self.listings.pop(dirname(path) or "/", None)
+        if path.endswith("/.hbroot"):
+            self.roots.clear()
 
 
 def _normpath(path):
@@ -52,15 +103,55 @@ def _find_root(path: str) -> str:
     raise FileNotFoundError(f"Cannot find root given {path}")
 
 
-def context(path: str = "", cls=_Context) -> _Context:
+def context(
+    path: str = "",
+    cls=_Context,
+    gitindex: bool = False,
+    cache: Optional[FsCache] = None,
+) -> _Context:
     """Create context based on given path, or current work directory
-    if not given.  Return path conext"""
+    if not given.  Return path conext.
+
+    If gitindex is True, file existence, stats and directory listings
+    for paths in the git work tree are answered from the git index.
+    If a file system cache is given, the context uses it instead of
+    private caches, so cached data is shared with other contexts.
+    """
     path = _normpath(path or getcwd())
-    return cls(
-        root=_find_root(path),
+    if cache is None:
+        root = _find_root(path)
+    else:
+        root = cache.roots.get(path)
+        if root is None:
+            root = cache.roots[path] = _find_root(path)
+    ctx = cls(
+        root=root,
         cwd=path,
         anchor=path,
     )
+    if cache is not None:
+        ctx._stat_cache = cache.stats
+        ctx._dir_cache = cache.dirs
+        ctx._listing = cache.listings
+        ctx._canon_cache = cache.canonical
+        ctx._list_cache = cache.lists
+    if gitindex:
+        ctx._index = _gitindex.load(ctx.root)
+        ctx._consulted[ctx._index.filename] = True
+    return ctx
+
+
+_CANON_CACHE_SIZE = 65536
+
+
+def _canonical(anchor: str, root: str, path: str) -> str:
+    if path[0] == "/":
+        pass
+    elif path.startswith("$root/"):
+        path = path.replace("$root", root, 1)
+    else:
+        path = f"{anchor}/{path}"
+    return _normpath(path)
 
 
 def canonical(context: _Context, path: str) -> str:
@@ -70,45 +161,213 @@ def canonical(context: _Context, path: str) -> str:
     Paths starting with $root/ are relative context.root.
     Surplus "/xxx/../", "/./", "//" etc are removed.
     Symlinks are not expanded.
+
+    Results are memoized in the context, evicting the oldest entries
+    when the memo is full.
     """
-    if path[0] == "/":
-        pass
-    elif path.startswith("$root/"):
-        path = path.replace("$root", context.root, 1)
-    else:
-        path = f"{context.anchor}/{path}"
-    return _normpath(path)
+    key = (context.anchor, context.root, path)
+    cache = context._canon_cache
+    cpath = cache.get(key)
+    if cpath is not None:
+        context.canon_hits += 1
+        return cpath
+    cpath = _canonical(context.anchor, context.root, path)
+    if len(cache) >= _CANON_CACHE_SIZE:
+        del cache[next(iter(cache))]
+    cache[key] = cpath
+    context.canon_misses += 1
+    return cpath
 
 
 def pathset(context: _Context, *paths: AnyPath) -> PathSet:
     """Create path set,
-    Return a dict where the keys are canoical absolute paths.
+    Return an immutable PathSet of canoical absolute paths.
+
+    Paths containing glob patterns (*, ? and [...], and ** for any
+    number of directories) are expanded to the matching paths.
+    List files are not expanded, use listfile() to read them.
 
     The insert order is preserved.
     For duplicates,  the first inserted is kept.
+    Path sets in the arguments are not copied, the returned path set
+    refers to them and is materialized when first iterated.  A single
+    path set argument is returned as is.
     """
-    pset = dict()
+    if len(paths) == 1 and isinstance(paths[0], PathSet):
+        return paths[0]
+    parts: List[PathSet] = []
+    ids = _add(context, parts, {}, paths)
+    if ids:
+        parts.append(PathSet.from_ids(ids))
+    return PathSet.concat(parts)
+
+
+def _add(
+    context: _Context,
+    parts: List[PathSet],
+    ids: Dict[int, None],
+    paths: Iterable[AnyPath],
+) -> Dict[int, None]:
+    """Add paths to list of path set parts, in one pass over nested
+    iterables.  Plain paths are collected as ids, path sets are added
+    as parts as is.  Return the ids not yet added to parts."""
     for path in paths:
         if isinstance(path, str):
             path = canonical(context, path)
-            if '@' in path:
-                pset.update(_exppath(context, path))
+            if "@" in path:
+                pset = _exppath(context, path)
+            elif _magic.search(path):
+                for p in glob(context, path):
+                    ids[intern(p)] = None
+                continue
             else:
-                pset[path] = True
+                ids[intern(path)] = None
+                continue
+        elif isinstance(path, PathSet):
+            pset = path
         elif isinstance(path, dict):
-            pset.update(path)
-        else:
             for p in path:
-                pset.update(pathset(context, p))
-    return pset
+                ids[intern(p)] = None
+            continue
+        else:
+            ids = _add(context, parts, ids, path)
+            continue
+        if ids:
+            parts.append(PathSet.from_ids(ids))
+            ids = {}
+        parts.append(pset)
+    return ids
 
 
-def paths(pathset: dict) -> Iterable[str]:
+def paths(pathset: PathSet) -> Iterable[str]:
     """Return iterator for paths in pathset, in insertion order"""
     return pathset.keys()
 
 
 _comment = re.compile(r"#.*$")
+_magic = re.compile(r"[*?[]")
+_special = re.compile(r"[*?[@]")
+
+
+def _read_list(context: _Context, path: str):
+    """Read list file, return (pathset, None) if it only contains plain
+    paths, otherwise (None, lines)"""
+    lines = []
+    plain = True
+    with open(path) as fh:
+        for line in fh:
+            line = line.partition("#")[0].strip()
+            if line:
+                lines.append(line)
+                if _special.search(line):
+                    plain = False
+    if not plain:
+        return None, lines
+    anchor = dirname(path)
+    root = context.root
+    return PathSet(_canonical(anchor, root, p) for p in lines), None
+
+
+def _listfile(context: _Context, path: str) -> PathSet:
+    fstat = _cached_stat(context, path)
+    signature = (fstat.st_mtime_ns, fstat.st_size, context.root)
+    cached = context._list_cache.get(path)
+    if cached is None or cached[0] != signature:
+        cached = context._list_cache[path] = (
+            signature,
+            *_read_list(context, path),
+        )
+    context._consulted[path] = True
+    if context._evalcache is not None:
+        context._evalcache.read(path)
+    _, pset, lines = cached
+    if pset is None:
+        anchor = context.anchor
+        context.anchor = dirname(path)
+        pset = pathset(context, lines)
+        context.anchor = anchor
+    return pset
+
+
+def listfile(context: _Context, path: str) -> PathSet:
+    """Read pathset from list file.
+    The list file contains one path per line, relative to the directory
+    of the list file.  Empty lines, and text after #, are ignored.
+    Paths are expanded as in pathset(), list files in it are not read.
+    The file is only read again if its stats have changed.
+    """
+    return _listfile(context, canonical(context, path))
+
+
+def listdir(context: _Context, directory: str) -> Dict[str, os.DirEntry]:
+    """Return, possibly cached, directory entries for a directory,
+    as a dict keyed by name, sorted by name.
+    Return an empty dict if the directory does not exist.
+
+    Use cache in context to only list each directory once.
+    The entries are also used to answer stat() queries for paths in
+    listed directories.
+    """
+    entries = context._listing.get(directory)
+    if entries is None:
+        index = context._index
+        if index is not None and index.covers(directory):
+            entries = index.listdir(directory)
+        else:
+            entries = _scandir(directory)
+        context._listing[directory] = entries
+    context._consulted[directory] = True
+    if context._evalcache is not None:
+        context._evalcache.listed(directory, entries)
+    return entries
+
+
+def _entry_name(entry: os.DirEntry) -> str:
+    return entry.name
+
+
+def _scandir(directory: str) -> Dict[str, os.DirEntry]:
+    try:
+        with os.scandir(directory) as it:
+            return {e.name: e for e in sorted(it, key=_entry_name)}
+    except (FileNotFoundError, NotADirectoryError):
+        return {}
+
+
+def _glob(context: _Context, directory: str, parts: List[str]):
+    if not parts:
+        yield directory
+        return
+    part, rest = parts[0], parts[1:]
+    if part == "**":
+        yield from _glob(context, directory, rest)
+        for name, entry in listdir(context, directory or "/").items():
+            if name[0] != "." and entry.is_dir() and not entry.is_symlink():
+                yield from _glob(context, f"{directory}/{name}", parts)
+    elif _magic.search(part):
+        hidden = part[0] == "."
+        for name in listdir(context, directory or "/"):
+            if (hidden or name[0] != ".") and fnmatchcase(name, part):
+                yield from _glob(context, f"{directory}/{name}", rest)
+    elif rest:
+        yield from _glob(context, f"{directory}/{part}", rest)
+    elif exists(context, f"{directory}/{part}"):
+        yield f"{directory}/{part}"
+
+
+def glob(context: _Context, pattern: str) -> Iterator[str]:
+    """Return iterator for existing paths matching a canonical absolute
+    glob pattern, in sorted order per directory.
+    "*", "?" and "[...]" match within a path component, and "**" matches
+    any number of directories.  Names starting with "." are only matched
+    by pattern components starting with ".".
+    Directory listings are cached in the context.
+    """
+    parts = pattern.split("/")
+    n = 1
+    while not _magic.search(parts[n]):
+        n += 1
+    return _glob(context, "/".join(parts[:n]), parts[n:])
 
 
 def _exppath(context: _Context, named_ps: str) -> PathSet:
@@ -116,15 +375,16 @@ def _exppath(context: _Context, named_ps: str) -> PathSet:
     Return pathset.
     """
     db = context.named_pathsets
-    pset = db.get(named_ps, {})
-    if pset:
-        return pset
-    directory = dirname(named_ps)
-    hbpy = f"{directory}/hb.py"
-    load_and_run(context, hbpy)
     pset = db.get(named_ps)
     if pset is None:
-        raise ValueError(f"Named pathset {named_ps} is not defined")
+        directory = dirname(named_ps)
+        hbpy = f"{directory}/hb.py"
+        load_and_run(context, hbpy)
+        pset = db.get(named_ps)
+        if pset is None:
+            raise ValueError(f"Named pathset {named_ps} is not defined")
+    if context._evalcache is not None:
+        context._evalcache.consumed(named_ps, pset)
     return pset
 
 
@@ -138,6 +398,8 @@ def export(context: _Context, name: str, *paths: AnyPath) -> PathSet:
     if fullname in db:
         raise ValueError(f"Named pathset {fullname} already defined")
     db[fullname] = pset
+    if context._evalcache is not None:
+        context._evalcache.exported(name, pset)
     return pset
 
 
@@ -164,77 +426,220 @@ def stat(context: _Context, path: str) -> os.stat_result:
     zero.
 
     Use cache in context to only access the file system once per path.
+    Paths in directories listed by listdir() are answered from the
+    directory entries, and paths in the git work tree from the git index
+    if the context uses it.
+    The path is recorded as consulted, see _probe().
     """
+    _probe(context, path)
+    return _cached_stat(context, path)
+
+
+def _probe(context: _Context, path: str):
+    """Record path probed by an hb.py file, the generation manifest and
+    the evaluation cache then depend on its stats"""
+    context._consulted[path] = True
+    if context._evalcache is not None:
+        context._evalcache.probed(path)
+
+
+def _cached_stat(context: _Context, path: str) -> os.stat_result:
+    """Return stats as stat(), without recording the path"""
     fstat = context._stat_cache.get(path)
     if fstat is not None:
         context.hits += 1
         return fstat
+    fstat = _stat(context, path)
+    context._stat_cache[path] = fstat
+    context.misses += 1
+    return fstat
+
+
+def _stat(context: _Context, path: str) -> os.stat_result:
+    directory, _, name = path.rpartition("/")
+    entries = context._listing.get(directory or "/")
+    index = context._index
     try:
-        fstat = os.stat(path)
+        if index is not None and index.covers(path):
+            fstat = index.stat(path) or _default_stat
+        elif entries is None:
+            fstat = os.stat(path)
+        elif name in entries:
+            fstat = entries[name].stat()
+        else:
+            fstat = _default_stat
     except FileNotFoundError:
         fstat = _default_stat
-    context._stat_cache[path] = fstat
-    context.misses += 1
     return fstat
 
 
+_PREFETCH_THRESHOLD = 256
+_PREFETCH_WORKERS = 16
+
+
+def prefetch(
+    context: _Context, paths: Iterable[str], workers: int = _PREFETCH_WORKERS
+) -> None:
+    """Fill stat cache in context for all given paths, using a pool of
+    worker threads to stat paths not already in the cache.
+    Stat system calls release the GIL, so this speeds up stats of
+    many paths on slow (network) file systems.
+    """
+    cache = context._stat_cache
+    missing = [p for p in paths if p not in cache]
+    if not missing:
+        return
+    with ThreadPoolExecutor(min(workers, len(missing))) as pool:
+        stats = pool.map(_stat, [context] * len(missing), missing)
+        cache.update(zip(missing, stats))
+    context.misses += len(missing)
+
+
+def _prefetch_large(context: _Context, paths: Iterable[str]) -> None:
+    """Prefetch stats if there are many paths"""
+    if len(paths) >= _PREFETCH_THRESHOLD:
+        prefetch(context, paths)
+
+
 def isdir(context: _Context, path: str) -> bool:
     """Return True if path is a directory, False otherwise, usees
     path stat cache"""
-    return S_ISDIR(stat(context, path).st_mode)
+    _probe(context, path)
+    return _isdir(context, path)
+
+
+def _isdir(context: _Context, path: str) -> bool:
+    return S_ISDIR(_cached_stat(context, path).st_mode)
 
 
 def exists(context: _Context, path: str) -> bool:
     """Return True if path exists, False otherwise, usees
     path stat cache"""
-    return stat(context, path).st_ctime != 0
+    _probe(context, path)
+    return _exists(context, path)
+
+
+def _exists(context: _Context, path: str) -> bool:
+    return _cached_stat(context, path).st_ctime != 0
 
 
 def newest(context: _Context, pathset: PathSet) -> str:
     """Return newest path in pathset"""
-    return max(pathset, key=lambda x: stat(context, x).st_mtime)
+    _prefetch_large(context, pathset)
+    return max(pathset, key=lambda x: _cached_stat(context, x).st_mtime)
 
 
 def oldest(context: _Context, pathset: PathSet) -> str:
     """Return oldest path in pathset"""
-    return min(pathset, key=lambda x: stat(context, x).st_mtime)
+    _prefetch_large(context, pathset)
+    return min(pathset, key=lambda x: _cached_stat(context, x).st_mtime)
 
 
 def directories(context: _Context, pathset: PathSet) -> PathSet:
     """Return directory part of all paths in pathset"""
     pset = {}
+    if len(pathset) >= _PREFETCH_THRESHOLD:
+        cached = context._dir_cache
+        prefetch(context, [p for p in pathset if p not in cached])
     for path in pathset:
         p = context._dir_cache.get(path)
         if not p:
-            if isdir(context, path):
+            if _isdir(context, path):
                 p = path
             else:
                 p = dirname(path)
             context._dir_cache[path] = p
         pset[p] = True
-    return pset
+    return PathSet(pset)
 
 
 def files(context: _Context, pathset: PathSet) -> PathSet:
     """Return all files in pathset. I.e. skip directories"""
-    return {path: True for path in pathset if not isdir(context, path)}
+    _prefetch_large(context, pathset)
+    return PathSet(path for path in pathset if not _isdir(context, path))
 
 
 _FilterReturnType = Union[Tuple[PathSet, ...], PathSet]
 
 
+_suffix_pattern = re.compile(r"\\\.(?:(\w+)|\(((?:\w+\|)*\w+)\))\$")
+_Matcher = Tuple[Dict[str, Tuple[int, ...]], List[Tuple[int, Any]]]
+
+
+@lru_cache(maxsize=256)
+def _matcher(patterns: Tuple[str, ...]) -> _Matcher:
+    """Compile filter patterns.  Return dict mapping file name suffixes
+    to pattern indexes for pure suffix patterns, like \\.h$ and
+    \\.(c|cc)$, and a list of (index, regexp) for other patterns."""
+    suffixes: Dict[str, Tuple[int, ...]] = {}
+    regexps = []
+    for n, pattern in enumerate(patterns):
+        m = _suffix_pattern.fullmatch(pattern)
+        if m:
+            for suffix in (m[1] or m[2]).split("|"):
+                suffixes[suffix] = suffixes.get(suffix, ()) + (n,)
+        else:
+            regexps.append((n, re.compile(pattern)))
+    return suffixes, regexps
+
+
 def filter(pathset: PathSet, *patterns: str) -> _FilterReturnType:
     """Filter out paths matching a set of patterns
-    Return one pathset per pattern"""
-    regexps = [re.compile(x) for x in patterns]
-    pathsets = tuple(
-        {x: True for x in pathset if r.search(x)} for r in regexps
-    )
+    Return one pathset per pattern.
+
+    All patterns are matched in one pass over the pathset.  Patterns
+    only matching a file name suffix are matched with a dict lookup.
+    """
+    suffixes, regexps = _matcher(patterns)
+    if not isinstance(pathset, PathSet):
+        pathset = PathSet(pathset)
+    matched: List[List[int]] = [[] for _ in patterns]
+    ids = pathset._materialize()
+    for i, path in zip(ids, pathset):
+        if suffixes:
+            dot = path.rfind(".")
+            if dot >= 0:
+                for n in suffixes.get(path[dot + 1 :], ()):
+                    matched[n].append(i)
+        for n, regexp in regexps:
+            if regexp.search(path):
+                matched[n].append(i)
+    pathsets = tuple(PathSet.from_ids(x) for x in matched)
     if len(pathsets) == 1:
         return pathsets[0]
     return pathsets
 
 
+_reldirs: Dict[str, Dict[str, str]] = {}
+_RELDIRS_MAX = 16
+
+
 def relative(frompath: str, pathset: PathSet) -> List[str]:
-    """Return list of relative paths for all paths in pathset"""
-    return [relpath(p, frompath) for p in pathset]
+    """Return list of relative paths for all paths in pathset.
+    Paths must be canonical.
+
+    The relative form of each directory is computed once per frompath
+    and memoized, so each path costs a string concatenation.
+    """
+    prefixes = _reldirs.get(frompath)
+    if prefixes is None:
+        if len(_reldirs) >= _RELDIRS_MAX:
+            _reldirs.clear()
+        prefixes = _reldirs[frompath] = {}
+    result = []
+    append = result.append
+    for path in pathset:
+        directory, _, name = path.rpartition("/")
+        prefix = prefixes.get(directory)
+        if prefix is None:
+            prefix = relpath(directory or "/", frompath)
+            prefix = "" if prefix == "." else f"{prefix}/"
+            prefixes[directory] = prefix
+        if name and not frompath.startswith(path):
+            append(prefix + name)
+        elif name and frompath[len(path) : len(path) + 1] not in ("", "/"):
+            append(prefix + name)
+        else:
+            # path is / or frompath or one of its parents
+            append(relpath(path, frompath))
+    return result
@@ -0,0 +1,150 @@
+"""
+Compact path sets
+
+Paths are interned in a process wide path table, and path sets store
+the integer ids of their paths in arrays.  Path sets are immutable, so
+the same path set can be shared by any number of builds.
+
+Path sets composed from other path sets are lazy concatenation views,
+deduplicated when first iterated, instead of copies.
+"""
+
+from array import array
+from collections.abc import Mapping
+from itertools import chain
+from typing import Dict, Iterable, Iterator, List, Optional, FrozenSet
+from typing import Sequence, Tuple
+
+
+_paths: List[str] = []
+_ids: Dict[str, int] = {}
+
+# Path sets larger than this get a hash set for membership tests
+_SET_THRESHOLD = 8
+
+
+def intern(path: str) -> int:
+    """Return id of path in the path table, add it if needed"""
+    i = _ids.get(path)
+    if i is None:
+        i = _ids[path] = len(_paths)
+        _paths.append(path)
+    return i
+
+
+class PathSet(Mapping):
+    """Immutable ordered set of paths.
+    Behaves as a read only dict with the paths as keys and True as values.
+    """
+
+    __slots__ = ("_ids", "_set", "_parts")
+
+    def __init__(self, paths: Iterable[str] = ()):
+        self._ids: Optional[array] = array(
+            "I", dict.fromkeys(map(intern, paths))
+        )
+        self._set: Optional[FrozenSet[int]] = None
+        self._parts: Tuple["PathSet", ...] = ()
+
+    @classmethod
+    def from_ids(cls, ids: Iterable[int]) -> "PathSet":
+        """Create path set from unique path ids"""
+        pset = cls.__new__(cls)
+        pset._ids = ids if isinstance(ids, array) else array("I", ids)
+        pset._set = None
+        pset._parts = ()
+        return pset
+
+    @classmethod
+    def concat(cls, parts: Sequence["PathSet"]) -> "PathSet":
+        """Create lazy path set with the paths of all parts, in order,
+        first occurence of duplicates kept"""
+        if not parts:
+            return EMPTY
+        if len(parts) == 1:
+            return parts[0]
+        pset = cls.__new__(cls)
+        pset._ids = None
+        pset._set = None
+        pset._parts = tuple(parts)
+        return pset
+
+    def _leaves(self) -> Iterator[array]:
+        """Iterate over id arrays of all materialized parts"""
+        seen = set()
+        stack = [self]
+        while stack:
+            pset = stack.pop()
+            if pset._ids is not None:
+                yield pset._ids
+            elif id(pset) not in seen:
+                seen.add(id(pset))
+                stack.extend(reversed(pset._parts))
+
+    def _materialize(self) -> array:
+        ids = self._ids
+        if ids is None:
+            ids = chain.from_iterable(self._leaves())
+            ids = self._ids = array("I", dict.fromkeys(ids))
+            self._parts = ()
+        return ids
+
+    def walk(self) -> Iterator[str]:
+        """Iterate over paths without caching the materialized form of
+        lazy path sets"""
+        if self._ids is not None:
+            return iter(self)
+        ids = dict.fromkeys(chain.from_iterable(self._leaves()))
+        return map(_paths.__getitem__, ids)
+
+    def parts(self) -> Tuple["PathSet", ...]:
+        """Return the path sets a lazy path set is composed of, empty
+        if it is materialized"""
+        return self._parts
+
+    def key(self) -> bytes:
+        """Return hashable key, equal for path sets with the same paths
+        in the same order"""
+        return self._materialize().tobytes()
+
+    def __iter__(self) -> Iterator[str]:
+        return map(_paths.__getitem__, self._materialize())
+
+    def __len__(self) -> int:
+        return len(self._materialize())
+
+    def __bool__(self) -> bool:
+        return any(map(len, self._leaves()))
+
+    def __contains__(self, path) -> bool:
+        i = _ids.get(path)
+        if i is None:
+            return False
+        ids = self._materialize()
+        if len(ids) <= _SET_THRESHOLD:
+            return i in ids
+        if self._set is None:
+            self._set = frozenset(ids)
+        return i in self._set
+
+    def __getitem__(self, path: str) -> bool:
+        if path in self:
+            return True
+        raise KeyError(path)
+
+    def __or__(self, other: "PathSet") -> "PathSet":
+        # Other iterables are not accepted, their paths would need to be
+        # made canonical by pathset()
+        if not isinstance(other, PathSet):
+            return NotImplemented
+        if not other:
+            return self
+        if not self:
+            return other
+        return PathSet.concat((self, other))
+
+    def __repr__(self) -> str:
+        return f"PathSet({list(self)!r})"
+
+
+EMPTY = PathSet()
@@ -0,0 +1,109 @@
+"""
+Generation profiling
+
+A Profile on the context (context.profile) records the time spent in
+each hb.py file, rule function and build() call, and the number of
+bytes written to ninja files.  Times are total (including everything
+called) and self (excluding other recorded calls), so the time of an
+hb.py file loaded to resolve a named path set is included in the total
+time of the hb.py file that referred to it, but not in its self time.
+"""
+
+import json
+from dataclasses import dataclass, field, asdict
+from os.path import relpath
+from time import perf_counter
+from typing import Any, Dict, List
+
+
+@dataclass
+class Timing:
+    calls: int = 0
+    total: float = 0.0
+    self: float = 0.0
+
+
+@dataclass
+class Profile:
+    files: Dict[str, Timing] = field(default_factory=dict)
+    rules: Dict[str, Timing] = field(default_factory=dict)
+    builds: Dict[str, Timing] = field(default_factory=dict)
+    bytes_written: int = 0
+    _stack: List[float] = field(default_factory=list)
+
+    def start(self) -> float:
+        """Start timing a call, return start time for stop()"""
+        self._stack.append(0.0)
+        return perf_counter()
+
+    def stop(self, table: Dict[str, Timing], key: str, start: float):
+        """Stop timing a call, and add it to table[key]"""
+        elapsed = perf_counter() - start
+        nested = self._stack.pop()
+        timing = table.get(key)
+        if timing is None:
+            timing = table[key] = Timing()
+        timing.calls += 1
+        timing.total += elapsed
+        timing.self += elapsed - nested
+        if self._stack:
+            self._stack[-1] += elapsed
+
+
+def _ratio(hits: int, misses: int) -> float:
+    return hits / (hits + misses) if hits + misses else 0.0
+
+
+def as_dict(context) -> Dict[str, Any]:
+    """Return profile of context as a JSON serializable dict"""
+    profile = context.profile
+    data = asdict(profile)
+    del data["_stack"]
+    data["stat_cache"] = {
+        "hits": context.hits,
+        "misses": context.misses,
+        "hit_rate": _ratio(context.hits, context.misses),
+    }
+    data["canonical_cache"] = {
+        "hits": context.canon_hits,
+        "misses": context.canon_misses,
+        "hit_rate": _ratio(context.canon_hits, context.canon_misses),
+    }
+    return data
+
+
+def dump(context, path: str):
+    """Write profile of context to JSON file"""
+    with open(path, "w") as fh:
+        json.dump(as_dict(context), fh, indent=1)
+
+
+def _table(title: str, table: Dict[str, Timing], name=str) -> List[str]:
+    lines = [title, f"{'self':>9} {'total':>9} {'calls':>7}  name"]
+    items = sorted(table.items(), key=lambda x: x[1].self, reverse=True)
+    for key, t in items:
+        lines.append(
+            f"{t.self:9.4f} {t.total:9.4f} {t.calls:7d}  {name(key)}"
+        )
+    return lines
+
+
+def report(context) -> str:
+    """Return profile of context as text, with the hb.py files, rules
+    and builds sorted by self time"""
+    profile = context.profile
+    cwd = context.cwd
+    data = as_dict(context)
+    lines = _table("hb.py files:", profile.files, lambda p: relpath(p, cwd))
+    lines += [""] + _table("Rule functions:", profile.rules)
+    lines += [""] + _table("build() calls per rule:", profile.builds)
+    lines.append("")
+    for name in ("stat_cache", "canonical_cache"):
+        cache = data[name]
+        lines.append(
+            f"{name.replace('_', ' ').capitalize()}: "
+            f"{cache['hits']} hits, {cache['misses']} misses, "
+            f"{cache['hit_rate']:.1%} hit rate"
+        )
+    lines.append(f"Ninja bytes written: {profile.bytes_written}")
+    return "\n".join(lines)
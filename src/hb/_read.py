@@ -2,76 +2,202 @@
 Read hb.py files
 """
 
-import importlib
-import importlib.util
+import hashlib
+import marshal
+import os
+import struct
 import sys
-from os import listdir
+from importlib.util import MAGIC_NUMBER
 from os.path import dirname, exists
-from typing import Tuple, Dict, Any
-from types import ModuleType
+from typing import Callable, Iterable, Tuple, Dict, Any, Optional
+from types import CodeType, ModuleType
 
 
 PathSet = Dict[str, bool]
 Context = Dict[str, Any]
 
+# Modules of the Python installation and of hb are not recorded as
+# inputs of hb.py files
+_system = tuple(
+    f"{p}/"
+    for p in {sys.prefix, sys.base_prefix, sys.exec_prefix, dirname(__file__)}
+)
 
-def _load_source(modname: str, filepath: str):
-    spec = importlib.util.spec_from_file_location(modname, filepath)
-    assert spec
-    mod = importlib.util.module_from_spec(spec)
-    assert spec.loader
-    spec.loader.exec_module(mod)
-    return mod
+
+_header = struct.Struct("<4sQQ20s")  # magic, mtime_ns, size, sha1
+
+
+def _module_name(hb_path: str) -> str:
+    return "hb_" + hashlib.sha1(hb_path.encode()).hexdigest()[:16]
 
 
-def load(hb_path: str) -> ModuleType:
-    """Load hb.py Python file"""
-    directory = dirname(hb_path)
-    sys.path.insert(0, directory)
-    mod = _load_source("read_hb", hb_path)
-    sys.path.pop(0)
+def _compile(hb_path: str, cache_dir: str) -> CodeType:
+    """Return code object for hb.py file.
+    The code is read from the bytecode cache in cache_dir if the
+    recorded stats, or else the hash, of the source file are unchanged.
+    Otherwise the source is compiled and the cache file is written."""
+    st = os.stat(hb_path)
+    cachefile = f"{cache_dir}/{_module_name(hb_path)}.bin"
+    header = None
+    try:
+        with open(cachefile, "rb") as fh:
+            data = fh.read()
+        header = _header.unpack_from(data)
+    except (FileNotFoundError, struct.error):
+        pass
+    if header and header[0] == MAGIC_NUMBER:
+        if header[1:3] == (st.st_mtime_ns, st.st_size):
+            return marshal.loads(data[_header.size :])
+    with open(hb_path, "rb") as fh:
+        source = fh.read()
+    digest = hashlib.sha1(source).digest()
+    if header and header[0] == MAGIC_NUMBER and header[3] == digest:
+        code = marshal.loads(data[_header.size :])
+    else:
+        code = compile(source, hb_path, "exec")
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = f"{cachefile}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(
+            _header.pack(MAGIC_NUMBER, st.st_mtime_ns, st.st_size, digest)
+        )
+        fh.write(marshal.dumps(code))
+    os.replace(tmp, cachefile)
+    return code
+
+
+def load(hb_path: str, cache_dir: str = "") -> ModuleType:
+    """Load hb.py Python file, as a module with a name unique for
+    the path.  If a cache directory is given, compiled code is cached
+    in it.  The directory of the file is first in sys.path while the
+    module is executed, so that it can import modules next to it."""
+    if cache_dir:
+        code = _compile(hb_path, cache_dir)
+    else:
+        with open(hb_path, "rb") as fh:
+            code = compile(fh.read(), hb_path, "exec")
+    mod = ModuleType(_module_name(hb_path))
+    mod.__file__ = hb_path
+    sys.path.insert(0, dirname(hb_path))
+    try:
+        exec(code, mod.__dict__)
+    finally:
+        sys.path.pop(0)
     return mod
 
 
+def _imported(mod: ModuleType, count: int) -> Dict[str, bool]:
+    """Return the source files of the modules that mod refers to, and
+    of the modules added to sys.modules after its first count entries,
+    while mod was loaded and run"""
+    modules = []
+    if len(sys.modules) > count:
+        modules = list(sys.modules.values())[count:]
+    for value in vars(mod).values():
+        if isinstance(value, ModuleType):
+            modules.append(value)
+            continue
+        name = getattr(value, "__module__", None)
+        if isinstance(name, str) and name in sys.modules:
+            modules.append(sys.modules[name])
+    files = {}
+    for module in modules:
+        path = getattr(module, "__file__", None)
+        if isinstance(path, str) and not path.startswith(_system):
+            files[path] = True
+    return files
+
+
 def load_and_run(context: Context, hb_path: str):
     """Load hb.py Python file and call build() function in it,
-    if it exists and has not already been called."""
+    if it exists and has not already been called.
+    If the context has an evaluation cache, the recorded outputs of
+    the build() function are replayed instead when still valid.
+    Compiled code is cached in context._bytecode, if set.
+    The time is recorded in context.profile, if set.
+    context._depth is the number of hb.py files being run.  When the
+    outermost file is done, hb.py files in the directories of the paths
+    used by its builds are loaded, see _rule._scan().
+    The source files of modules imported by the hb.py file are added to
+    context._imported."""
     if hb_path in context._loaded:
         return
     context._loaded[hb_path] = True
-    mod = load(hb_path)
-    if hasattr(mod, "build"):
-        anchor = context.anchor
-        context.anchor = dirname(hb_path)
-        mod.build(context)
-        context.anchor = anchor
+    context._depth += 1
+    profile = context.profile
+    start = profile.start() if profile is not None else 0.0
+    try:
+        _run(context, hb_path)
+    finally:
+        context._depth -= 1
+        if profile is not None:
+            profile.stop(profile.files, hb_path, start)
+    if not context._depth:
+        # Imported here, _rule imports this module
+        from ._rule import _discover
+
+        _discover(context)
+
+
+def _run(context: Context, hb_path: str):
+    cache = context._evalcache
+    if cache is not None and cache.replay(context, hb_path):
+        return
+    count = len(sys.modules)
+    mod = load(hb_path, context._bytecode)
+    if not hasattr(mod, "build"):
+        context._imported.update(_imported(mod, count))
+        return
+    anchor = context.anchor
+    context.anchor = dirname(hb_path)
+    if cache is not None:
+        cache.begin(context, hb_path)
+    mod.build(context)
+    imported = _imported(mod, count)
+    context._imported.update(imported)
+    if cache is not None:
+        cache.imported(imported)
+        cache.end(context, hb_path)
+    context.anchor = anchor
 
 
 def scan(
-    directories: PathSet, filename="hb.py", scanned: PathSet = {}
-) -> Tuple[PathSet, PathSet]:
+    directories: Iterable[str],
+    filename="hb.py",
+    scanned: Optional[Dict[str, str]] = None,
+    exists: Callable[[str], bool] = exists,
+) -> Tuple[PathSet, Dict[str, str]]:
     """Scan for files with a given name (default hb.py), in a
     set of directories and their parent directories (up until
-    a .hbroot file is found or /).
-    Return a pathset containing the found files, and a pathset
-    containing the directories that were scanned.  The latter
-    can be fed to subsequent calls to scan to avoid scanning
-    directories more than once.
+    a directory with a .hbroot file, or /).
+    Return a pathset containing the found files, and a dict that maps
+    each scanned directory to the file that owns it: the file in the
+    directory or in its nearest parent directory, or "" if none.
+    The latter can be fed to subsequent calls to scan to avoid scanning
+    directories more than once, it is updated in place.  The search
+    stops at the first scanned directory, so sub directories of scanned
+    directories are resolved with one lookup.
+    The exists function returns True if a path exists.
     """
     files = {}
-    scanned = dict(scanned)
+    if scanned is None:
+        scanned = {}
     for directory in directories:
-        if directory in scanned:
-            continue
-        scanned[directory] = True
-        if exists(directory):
-            filenames = listdir(directory)
-            if filename in filenames:
-                files[f"{directory}/{filename}"] = True
-                continue
-            if ".hbroot" in files or directory == "/":
-                continue
-        f, s = scan({dirname(directory): True}, filename, scanned)
-        files.update(f)
-        scanned.update(s)
+        walked = []
+        owner = scanned.get(directory)
+        while owner is None:
+            walked.append(directory)
+            scanned[directory] = ""
+            path = f"{directory if directory != '/' else ''}/{filename}"
+            if exists(path):
+                files[path] = True
+                owner = path
+                break
+            if directory == "/" or exists(f"{directory}/.hbroot"):
+                owner = ""
+                break
+            directory = dirname(directory)
+            owner = scanned.get(directory)
+        for directory in walked:
+            scanned[directory] = owner
     return files, scanned
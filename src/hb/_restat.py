@@ -0,0 +1,102 @@
+"""
+Content hash restat for ninja builds
+
+Usage: python _restat.py DATABASE COMMANDFILE OUTPUT...
+
+Runs the shell command in COMMANDFILE (a ninja rspfile), and restores
+the previous modification time of each OUTPUT whose content did not
+change.  With restat = 1 ninja then skips the builds depending on it.
+
+The content hash and modification time of each output are stored in a
+file per output in the DATABASE directory.  The stored hash is used if
+the output still has the stored modification time, otherwise the output
+is hashed before the command is run.
+"""
+
+import hashlib
+import os
+import subprocess
+import sys
+from typing import List, Optional, Tuple
+
+
+# This file is run as a script, by path, and does not import from hb
+
+
+def _hash(path: str) -> str:
+    digest = hashlib.sha1()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _entry(database: str, output: str) -> str:
+    name = hashlib.sha1(os.path.abspath(output).encode()).hexdigest()
+    return f"{database}/{name}"
+
+
+def _read(entry: str) -> Tuple[str, int]:
+    try:
+        with open(entry) as fh:
+            digest, mtime = fh.read().split()
+        return digest, int(mtime)
+    except (OSError, ValueError):
+        return "", 0
+
+
+def _write(entry: str, digest: str, mtime: int):
+    tmp = f"{entry}.{os.getpid()}.tmp"
+    with open(tmp, "w") as fh:
+        fh.write(f"{digest} {mtime}\n")
+    os.replace(tmp, entry)
+
+
+def before(database: str, output: str) -> Tuple[str, int]:
+    """Return content hash and modification time of output, or empty
+    hash if it does not exist"""
+    try:
+        mtime = os.stat(output).st_mtime_ns
+    except OSError:
+        return "", 0
+    digest, stored = _read(_entry(database, output))
+    if stored != mtime:
+        digest = _hash(output)
+    return digest, mtime
+
+
+def after(database: str, output: str, digest: str, mtime: int):
+    """Restore modification time of output if its content hash is
+    digest, and store its hash and modification time"""
+    try:
+        st = os.stat(output)
+    except OSError:
+        return
+    new = _hash(output)
+    if digest and new == digest:
+        os.utime(output, ns=(st.st_atime_ns, mtime))
+    else:
+        mtime = st.st_mtime_ns
+    _write(_entry(database, output), new, mtime)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = sys.argv[1:] if argv is None else argv
+    if len(args) < 3:
+        print(__doc__.split("\n\n")[1], file=sys.stderr)
+        return 2
+    database, cmdfile, *outputs = args
+    os.makedirs(database, exist_ok=True)
+    with open(cmdfile) as fh:
+        command = fh.read().strip()
+    old = [before(database, output) for output in outputs]
+    returncode = subprocess.run(command, shell=True).returncode
+    if returncode:
+        return returncode
+    for output, (digest, mtime) in zip(outputs, old):
+        after(database, output, digest, mtime)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,18 @@
-from typing import Dict, Callable, List, Tuple
+from typing import Dict, Callable, Iterable, List, Tuple
 from dataclasses import dataclass, field
+import hashlib
+import io
+import os
 import re
+import sys
+from functools import partial
+from os.path import dirname, relpath
 import ninja
 from ._path import PathSet, pathset, AnyPath, directories, relative
+from ._path import canonical, exists, _exists
 from ._path import _Context as _PathContext
 from ._read import scan, load_and_run
+from . import _manifest, _evalcache, _ninja
 
 
 _CallBack = Callable[["_Context"], Tuple[PathSet, PathSet]]
@@ -22,11 +30,13 @@ class _Rule:
     deps: PathSet
     oodeps: PathSet
     func: Callable = lambda: None
+    origin: str = ""
     used: bool = False
     pool: str = ""
     maxpar: int = 0
     vars: Dict[str, str] = field(default_factory=dict)
     callback: _CallBack = _default_callback
+    restat: bool = False
 
 
 @dataclass
@@ -37,16 +47,30 @@ class _Build:
     deps: PathSet
     oodeps: PathSet
     vars: Dict[str, str]
+    origin: str = ""
 
 
 @dataclass
 class _Context(_PathContext):
     _rules: Dict[str, _Rule] = field(default_factory=dict)
-    targets: PathSet = field(default_factory=dict)
+    targets: Dict[str, bool] = field(default_factory=dict)
     _builds: List[_Build] = field(default_factory=list)
-    _scanned: PathSet = field(default_factory=dict)
+    _scanned: Dict[str, str] = field(default_factory=dict)
+    _targeted: bool = False
+    _pending: Dict[str, bool] = field(default_factory=dict)
+    _seen: Dict[int, PathSet] = field(default_factory=dict)
 
 
+# Dependency path sets with at least _GROUP_MIN_SIZE paths, used by
+# at least _GROUP_MIN_USES builds, are written as phony group targets
+_GROUP_MIN_SIZE = 4
+_GROUP_MIN_USES = 2
+
+# Commands of rules with content hash restat are run by this script,
+# by path like the dyndep scanner of the gcc rule
+_restat = f"{dirname(__file__)}/_restat.py"
+_restat_command = f"{sys.executable} {_restat} .hb/restat $rspfile $out"
+
 _var = re.compile(r"\$\{?(\w+)\}?")
 _ninja_stdvar = set(
     (
@@ -55,6 +79,7 @@ _ninja_stdvar = set(
         "depfile",
         "deps",
         "description",
+        "dyndep",
         "generator",
         "pool",
         "restat",
@@ -73,6 +98,7 @@ def rule(
     oodeps: AnyPath = {},
     callback: _CallBack = _default_callback,
     name: str = "",
+    restat: bool = False,
     **vars: str,
 ) -> Callable[[Callable], Callable]:
     """Rule decorator, create a rule function
@@ -90,6 +116,9 @@ def rule(
                   and shall return one pathset for extra dependencies
                   and one pathset for extra order only dependencies.
         name: Optional rule name, if not given the function name is used.
+        restat: If True, outputs whose content did not change keep their
+                modification time, and builds depending on them are not
+                rerun. Content hashes are stored under .hb/restat.
         **vars: Optional default values for command variables.
 
         Standard variables in command string:
@@ -113,18 +142,30 @@ def rule(
 
         def func(*args, **kwargs):
             rule.used = True
-            return function(*args, **kwargs)
+            profile = context.profile
+            if profile is None:
+                return function(*args, **kwargs)
+            start = profile.start()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.stop(profile.rules, funcname, start)
 
         func.__doc__ = function.__doc__
         func.__name__ = funcname
         rule.func = func
+        rule.origin = function.__code__.co_filename
         rule.vars = vars
         rule.pool = pool
         rule.maxpar = maxpar
+        rule.callback = callback
+        rule.restat = restat
         if funcname in context._rules or getattr(context, funcname, False):
             raise KeyError(f"Name {funcname} already defined")
         context._rules[funcname] = rule
         setattr(context, funcname, func)
+        if context._evalcache is not None:
+            context._evalcache.defined(rule)
 
         return func
 
@@ -155,20 +196,71 @@ def build(
         depfile: Use optional lazy dependency file (True or False)
         **vars: variables to be expanded in the rule command string
     """
+    profile = context.profile
+    if profile is None:
+        _build(context, function, dst, src, deps, oodeps, vars)
+        return
+    start = profile.start()
+    try:
+        _build(context, function, dst, src, deps, oodeps, vars)
+    finally:
+        profile.stop(profile.builds, function.__name__, start)
+
+
+def _build(
+    context: _Context,
+    function: Callable,
+    dst: AnyPath,
+    src: AnyPath,
+    deps: AnyPath,
+    oodeps: AnyPath,
+    vars: Dict[str, str],
+):
     dst = pathset(context, dst)
     src = pathset(context, src)
     deps = pathset(context, deps)
     oodeps = pathset(context, oodeps)
-    context.targets.update(dst)
-    context._builds.append(
-        _Build(function.__name__, dst, src, deps, oodeps, vars)
-    )
-
-    files, context._scanned = scan(
-        directories(context, {**src, **deps, **oodeps}),
-        "hb.py",
-        context._scanned,
+    context.targets.update(dict.fromkeys(dst, True))
+    b = _Build(
+        function.__name__, dst, src, deps, oodeps, vars, context.anchor
     )
+    context._builds.append(b)
+
+    if context._evalcache is not None:
+        context._evalcache.built(context._rules[b.rule], b)
+    _scan(context, (src, deps, oodeps))
+
+
+def _scan(context: _Context, psets: Iterable[PathSet]):
+    """Scan the directories of paths for hb.py files, and load them.
+    Path sets seen before are skipped, and the paths are only collected
+    while hb.py files are running.  They are scanned in one batch when
+    the outermost hb.py file is done, see _discover().
+    In targeted mode hb.py files are instead loaded when needed to
+    find the producer of a path, see _select()."""
+    if context._targeted:
+        return
+    seen = context._seen
+    pending = context._pending
+    for pset in psets:
+        if id(pset) not in seen:
+            seen[id(pset)] = pset
+            pending.update(dict.fromkeys(pset, True))
+    if not context._depth:
+        _discover(context)
+
+
+def _discover(context: _Context):
+    """Scan the directories of collected paths for hb.py files, and
+    load them, until no more paths are collected"""
+    while context._pending:
+        paths = PathSet(context._pending)
+        context._pending = {}
+        _load_dirs(context, directories(context, paths))
+
+
+def _load_dirs(context: _Context, dirs: Iterable[str]):
+    files, _ = scan(dirs, "hb.py", context._scanned, partial(_exists, context))
     for file in files:
         load_and_run(context, file)
 
@@ -190,7 +282,7 @@ def _extract_cmd_vars(rule):
         if var in _ninja_stdvar:
             return m[0]
         var = f"{name}_{var}"
-        vars[var] = ""
+        vars.setdefault(var, "")
         return f"${{{var}}}"
 
     for var in rule.vars:
@@ -199,7 +291,20 @@ def _extract_cmd_vars(rule):
     return _var.sub(repl, rule.command), vars
 
 
+def _apply_callback(context: _Context, rule: _Rule):
+    """Call rule callback, and add the returned dependencies to the rule.
+    The callback is only called once."""
+    if rule.callback is _default_callback:
+        return
+    edeps, eoodeps = rule.callback(context)
+    rule.deps = pathset(context, rule.deps, edeps)
+    rule.oodeps = pathset(context, rule.oodeps, eoodeps)
+    rule.callback = _default_callback
+
+
 def _write_rule(context: _Context, writer, rule):
+    # The callback may set default values of rule variables
+    _apply_callback(context, rule)
     command, vars = _extract_cmd_vars(rule)
     for name in vars:
         writer.variable(name, vars[name])
@@ -208,40 +313,343 @@ def _write_rule(context: _Context, writer, rule):
     if maxpar:
         pool = f"{rule.name}_pool"
         writer.pool(pool, maxpar)
-    edeps, eoodeps = rule.callback(context)
-    rule.deps.update(edeps)
-    rule.oodeps.update(eoodeps)
-    writer.rule(
-        rule.name,
-        command,
-        depfile=rule.vars.get("depfile"),
-        pool=pool,
-        generator=None,
-    )
+    if rule.restat:
+        # The command is written to a per build rspfile by ninja, and
+        # run from there, which avoids quoting it
+        writer.rule(
+            rule.name,
+            _restat_command,
+            depfile=rule.vars.get("depfile"),
+            pool=pool,
+            restat=True,
+            rspfile=f"${{{rule.name}_rspfile}}",
+            rspfile_content=command,
+        )
+    else:
+        writer.rule(
+            rule.name,
+            command,
+            depfile=rule.vars.get("depfile"),
+            pool=pool,
+            generator=None,
+        )
     writer.newline()
 
 
-def _write_build(context: _Context, writer, build):
+def _select(context: _Context, targets: Iterable[str]):
+    """Keep only the builds needed for the given targets (paths relative
+    the context directory), and the builds of their transitive inputs.
+    hb.py files are loaded as needed to find the build producing a path,
+    by scanning the directory of the path and its parents.
+    Rule callbacks are applied when all targets have been found, and
+    the builds of the dependencies they add are also kept.
+    Raise ValueError if a target is neither built nor an existing file.
+    """
+    builds = context._builds
+    rules = context._rules
+    producers: Dict[str, _Build] = {}
+    needed: Dict[int, _Build] = {}
+    visited: Dict[str, bool] = {}
+    used: Dict[str, _Rule] = {}
+    indexed = 0
+
+    def walk(paths: Iterable[str]):
+        nonlocal indexed
+        stack = list(paths)
+        while stack:
+            path = stack.pop()
+            if path in visited:
+                continue
+            visited[path] = True
+            while True:
+                for build in builds[indexed:]:
+                    for dst in build.dst:
+                        producers.setdefault(dst, build)
+                indexed = len(builds)
+                build = producers.get(path)
+                if build is not None:
+                    break
+                _load_dirs(context, (dirname(path),))
+                if indexed == len(builds):
+                    break
+            if build is None or id(build) in needed:
+                continue
+            needed[id(build)] = build
+            for pset in (build.src, build.deps, build.oodeps):
+                stack.extend(pset)
+            if build.rule not in used:
+                rule = used[build.rule] = rules[build.rule]
+                stack.extend(rule.deps)
+                stack.extend(rule.oodeps)
+
+    paths = {canonical(context, target): target for target in targets}
+    walk(paths)
+    for path, target in paths.items():
+        if path not in producers and not exists(context, path):
+            raise ValueError(f"No build for target {target}")
+    applied: Dict[str, bool] = {}
+    while len(applied) < len(used):
+        for name, rule in list(used.items()):
+            if name not in applied:
+                applied[name] = True
+                _apply_callback(context, rule)
+                walk(rule.deps)
+                walk(rule.oodeps)
+    context._builds = [b for b in builds if id(b) in needed]
+
+
+def _unique(builds: List[_Build]) -> List[_Build]:
+    """Return builds without the repeated ones, builds with the same
+    rule, paths and variables, that different hb.py files (or calls of
+    the same rule function) may create for a shared output"""
+    seen = {}
+    unique = []
+    for build in builds:
+        key = (
+            build.rule,
+            build.dst.key(),
+            build.src.key(),
+            build.deps.key(),
+            build.oodeps.key(),
+            repr(sorted(build.vars.items())),
+        )
+        if key not in seen:
+            seen[key] = True
+            unique.append(build)
+    return unique
+
+
+def _dep_groups(
+    context: _Context, builds: List[_Build]
+) -> Dict[bytes, Tuple[str, PathSet]]:
+    """Find dependency path sets with at least _GROUP_MIN_SIZE paths that
+    are used by at least _GROUP_MIN_USES builds.
+    Return dict with (group target name, path set) keyed on path set key.
+    """
+    rules = context._rules
+    keys: Dict[int, bytes] = {}
+    uses: Dict[bytes, int] = {}
+    psets: Dict[bytes, PathSet] = {}
+    for build in builds:
+        rule = rules[build.rule]
+        for pset in (build.deps, rule.deps, build.oodeps, rule.oodeps):
+            key = keys.get(id(pset))
+            if key is None:
+                if len(pset) < _GROUP_MIN_SIZE:
+                    key = keys[id(pset)] = b""
+                    continue
+                key = keys[id(pset)] = pset.key()
+                psets[key] = pset
+            if key:
+                uses[key] = uses.get(key, 0) + 1
+    groups = {}
+    cwd = context.cwd
+    for key, n in uses.items():
+        if n >= _GROUP_MIN_USES:
+            paths = "\n".join(relative(cwd, psets[key]))
+            digest = hashlib.sha1(paths.encode()).hexdigest()[:16]
+            groups[key] = (f"_hb_deps_{digest}", psets[key])
+    return groups
+
+
+def _write_groups(context: _Context, writer, groups):
+    for name, pset in groups.values():
+        writer.build(name, "phony", relative(context.cwd, pset))
+    if groups:
+        writer.newline()
+
+
+def _grouped(
+    context: _Context, groups, psets: Tuple[PathSet, ...]
+) -> List[str]:
+    """Return relative paths of path sets, with path sets that
+    are in a group replaced by the group target"""
+    direct = []
+    names = []
+    for pset in psets:
+        group = None
+        if len(pset) >= _GROUP_MIN_SIZE:
+            group = groups.get(pset.key())
+        if group is None:
+            direct.append(pset)
+        elif group[0] not in names:
+            names.append(group[0])
+    return relative(context.cwd, PathSet.concat(direct)) + names
+
+
+def _write_build(context: _Context, writer, build, groups={}):
     cwd = context.cwd
     rule = context._rules[build.rule]
     dst = relative(cwd, build.dst)
     src = relative(cwd, build.src)
-    deps = relative(cwd, {**build.deps, **rule.deps})
-    oodeps = relative(cwd, {**build.oodeps, **rule.oodeps})
-    vars = build.vars
+    if groups:
+        deps = _grouped(context, groups, (build.deps, rule.deps))
+        oodeps = _grouped(context, groups, (build.oodeps, rule.oodeps))
+    else:
+        deps = relative(cwd, build.deps | rule.deps)
+        oodeps = relative(cwd, build.oodeps | rule.oodeps)
+    vars = {
+        k if k in _ninja_stdvar else f"{rule.name}_{k}": v
+        for k, v in build.vars.items()
+    }
     if rule.vars.get("depfile"):
         vars["depfile"] = ".hb/" + _mangle_path(f"{dst[0]}.d")
+    if rule.restat:
+        vars[f"{rule.name}_rspfile"] = ".hb/" + _mangle_path(f"{dst[0]}.cmd")
     writer.build(dst, build.rule, src, deps, oodeps, vars)
     if "/" not in dst[0]:
         writer.default(dst)
 
 
-def write_ninja(context: _Context, fh):
-    """Write ninja build file"""
-    writer = ninja.Writer(fh)
+def _write_rules(context: _Context, writer):
     writer.variable("builddir", ".hb")
     for rule in context._rules.values():
         if rule.used:
             _write_rule(context, writer, rule)
-    for build in context._builds:
-        _write_build(context, writer, build)
+
+
+def write_ninja(
+    context: _Context, fh, fast: bool = True, group: bool = True
+):
+    """Write ninja build file.
+    The buffered writer in _ninja is used if fast is True, otherwise
+    ninja.Writer.  Both produce the same output.
+    If group is True, dependency path sets shared by several builds are
+    written once, as phony targets that the builds depend on.
+    Repeated identical builds are written once.
+    """
+    builds = _unique(context._builds)
+    writer = _ninja.Writer(fh) if fast else ninja.Writer(fh)
+    _write_rules(context, writer)
+    groups = _dep_groups(context, builds) if group else {}
+    _write_groups(context, writer, groups)
+    for build in builds:
+        _write_build(context, writer, build, groups)
+    if fast:
+        writer.flush()
+        if context.profile is not None:
+            context.profile.bytes_written += writer.written
+
+
+def _subninja_name(cwd: str, origin: str) -> str:
+    """Return subninja file name of hb.py directory.  The mangled path
+    is followed by a digest of the path, mangling is not injective."""
+    rel = relpath(origin, cwd)
+    if rel == ".":
+        return "top.ninja"
+    digest = hashlib.sha1(rel.encode()).hexdigest()[:8]
+    return f"{_mangle_path(rel)}_{digest}.ninja"
+
+
+def _update(context: _Context, path: str, text: str) -> bool:
+    if not _ninja.update_file(path, text):
+        return False
+    if context.profile is not None:
+        context.profile.bytes_written += len(text.encode())
+    return True
+
+
+def write_split(
+    context: _Context, ninja_file: str, group: bool = True
+) -> int:
+    """Write ninja build file with the rules, that includes one subninja
+    file in .hb/ninja/ per hb.py directory, with the builds created by
+    that hb.py file.  Files are only written if their content changed,
+    and subninja files that are no longer used are removed.
+    Dependency groups (see write_ninja()) are written to the top file.
+    Return the number of written files.
+    """
+    cwd = context.cwd
+    builds = _unique(context._builds)
+    origins: Dict[str, List[_Build]] = {}
+    for build in builds:
+        origins.setdefault(build.origin or cwd, []).append(build)
+    subdir = f"{cwd}/.hb/ninja"
+    os.makedirs(subdir, exist_ok=True)
+    fh = io.StringIO()
+    top = _ninja.Writer(fh)
+    _write_rules(context, top)
+    groups = _dep_groups(context, builds) if group else {}
+    _write_groups(context, top, groups)
+    names = {}
+    written = 0
+    for origin, origin_builds in origins.items():
+        name = _subninja_name(cwd, origin)
+        names[name] = True
+        sub = io.StringIO()
+        writer = _ninja.Writer(sub)
+        for build in origin_builds:
+            _write_build(context, writer, build, groups)
+        writer.flush()
+        written += _update(context, f"{subdir}/{name}", sub.getvalue())
+        top.subninja(f".hb/ninja/{name}")
+    top.flush()
+    written += _update(context, ninja_file, fh.getvalue())
+    for name in os.listdir(subdir):
+        if name not in names:
+            os.unlink(f"{subdir}/{name}")
+    return written
+
+
+def generate(
+    context: _Context,
+    ninja_file: str = "build.ninja",
+    key: str = "",
+    split: bool = False,
+    targets: Iterable[str] = (),
+) -> bool:
+    """Generate ninja file from the hb.py file in the context directory.
+    Nothing is loaded if the generation manifest in .hb/ shows that
+    no hb.py file, or directory consulted by the previous generation
+    has changed.  Otherwise, unchanged hb.py files are replayed from
+    the evaluation cache in .hb/, and the others are loaded with
+    compiled code cached in .hb/bytecode/.
+    If split is True, builds are written to one subninja file per
+    hb.py directory (see write_split()).
+    If targets are given, only the hb.py files and builds needed for
+    them are loaded and written (see _select()).  Scanned hb.py files
+    are then not loaded while the top hb.py file is running.
+    The manifest is only valid for the same key, and the same
+    generation options (git index mode, split and targets), as long
+    as the written ninja files (subninja files included) are
+    unmodified.
+    If the context is profiled, neither the manifest nor the evaluation
+    cache is used, so that all hb.py files are run and timed.
+    Return True if the ninja file was (re)generated.
+    """
+    cwd = context.cwd
+    ninja_file = f"{cwd}/{ninja_file}"
+    manifest = f"{cwd}/.hb/manifest.json"
+    options = [key]
+    if context._index is not None:
+        options.append("gitindex")
+    if split:
+        options.append("split")
+    targets = list(targets)
+    if targets:
+        options.append(f"targets={','.join(targets)}")
+    key = " ".join(filter(None, options))
+    profiled = context.profile is not None
+    if not profiled and _manifest.up_to_date(manifest, ninja_file, key):
+        return False
+    cachefile = f"{cwd}/.hb/evalcache.json"
+    if not profiled:
+        context._evalcache = _evalcache.load(cachefile)
+    context._bytecode = f"{cwd}/.hb/bytecode"
+    context._targeted = bool(targets)
+    load_and_run(context, f"{cwd}/hb.py")
+    if targets:
+        _select(context, targets)
+    outputs = [ninja_file]
+    if split:
+        write_split(context, ninja_file)
+        # Only the subninja files in use are left
+        subdir = f"{cwd}/.hb/ninja"
+        outputs += (f"{subdir}/{name}" for name in os.listdir(subdir))
+    else:
+        with _ninja.atomic_open(ninja_file) as fh:
+            write_ninja(context, fh)
+    if not profiled:
+        _evalcache.save(context._evalcache, cachefile)
+    _manifest.write(context, manifest, outputs, key)
+    return True
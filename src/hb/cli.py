@@ -1,5 +1,9 @@
-from ._path import pathset, relative, context
+from ._path import pathset, relative
+from . import context, _profile
 import click
+import os
+import subprocess
+import sys
 from os import getcwd
 
 
@@ -17,5 +21,35 @@ def explist(absolute, listfiles):
             print(p)
 
 
-def main():
-    print("RUN")
+@click.command(context_settings={"ignore_unknown_options": True})
+@click.option(
+    "--gitindex",
+    is_flag=True,
+    help="Enumerate files from the git index instead of the file system",
+)
+@click.option(
+    "--split",
+    is_flag=True,
+    help="Write one subninja file per hb.py directory",
+)
+@click.option(
+    "--target",
+    multiple=True,
+    help="Only load and write what is needed for this target, "
+    "and build it.  Can be given more than once.",
+)
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="Print where generation time is spent, "
+    "and write it to .hb/profile.json",
+)
+@click.argument("ninja_args", nargs=-1, type=click.UNPROCESSED)
+def main(gitindex, split, target, profile, ninja_args):
+    ctx = context(gitindex=gitindex, profile=profile)
+    ctx.generate(split=split, targets=target)
+    if profile:
+        print(_profile.report(ctx))
+        os.makedirs(f"{ctx.cwd}/.hb", exist_ok=True)
+        _profile.dump(ctx, f"{ctx.cwd}/.hb/profile.json")
+    sys.exit(subprocess.call(["ninja", *ninja_args, *target]))
@@ -1,4 +1,33 @@
-from os.path import basename, splitext
+import hashlib
+import shlex
+import sys
+from os.path import basename, dirname, relpath, splitext
+
+
+_command = (
+    "$launcher gcc -MMD -MF $depfile $fix $cflags $incp $pch -c $in -o $out"
+)
+_pch_command = (
+    "$launcher gcc -MMD -MF $depfile $fix $cflags $incp -x $language "
+    "-c $in -o $out"
+)
+# Precompiled header language per source file extension, assembly files
+# are compiled without precompiled header, and outside of unity builds
+_pch_languages = {".c": "c-header", ".cc": "c++-header", ".cpp": "c++-header"}
+_wrapper_command = "echo '#include \"$header\"' > $out"
+# The command changes with the list of included files, and ninja only
+# reruns it then, so unity sources are only rewritten when changed
+_unity_command = "printf '%s\\n' $lines > $out"
+# Run the scanner script by path, python -m would find the hb.py
+# file in the build directory instead of the hb package
+_dyndep = f"{dirname(dirname(__file__))}/_dyndep.py"
+# Generated headers the scanner looks for, one per line, relative to
+# the build directory.  Written by _scan_callback().
+_genh_list = ".hb/gcc_scan.genh"
+_scan_command = (
+    f"{sys.executable} {_dyndep} $out $depfile $obj {_genh_list} -- "
+    "gcc -MM -MG $fix $cflags $incp $in"
+)
 
 
 def _callback(hb):
@@ -6,16 +35,64 @@ def _callback(hb):
     return {}, gen_h_files
 
 
+def _scan_callback(hb):
+    gen_h_files = hb.filter(hb.targets, r"\.h$")
+    lines = "".join(f"{p}\n" for p in hb.relative(hb.cwd, gen_h_files))
+    # Only written when changed, so that scans are only redone then
+    genh = f"{hb.cwd}/{_genh_list}"
+    hb.update_file(genh, lines)
+    return genh, {}
+
+
+def _batches(hb, cfiles, count, size):
+    """Split cfiles into batches of at most count files, and at most
+    size bytes if size is given (a larger file gets its own batch)"""
+    batch = []
+    total = 0
+    for cfile in cfiles:
+        fsize = hb.stat(cfile).st_size if size else 0
+        if batch and (len(batch) == count or total + fsize > size > 0):
+            yield batch
+            batch = []
+            total = 0
+        batch.append(cfile)
+        total += fsize
+    if batch:
+        yield batch
+
+
 def build(hb):
-    @hb.rule(
-        "gcc -MMD -MF $depfile $fix $cflags $incp -c $in -o $out",
-        callback=_callback,
-    )
-    def gcc(src="gcc.list", link=None, lib=None, **vars):
+    @hb.rule(_command, callback=_callback, depfile=True)
+    def gcc(
+        src=None,
+        link=None,
+        lib=None,
+        dyndep=False,
+        launcher="",
+        pch=None,
+        unity=0,
+        unity_size=0,
+        **vars,
+    ):
         """
         Compile C code using GCC.
+        src defaults to the paths listed in gcc.list, see listfile().
+        Compilations wait for all generated headers, unless dyndep
+        is True.  Then each source file is scanned for the generated
+        headers it includes, and its compilation only waits for them.
+        launcher is an optional command compilations are run with,
+        like ccache.  pch is an optional header that is precompiled,
+        once per language, and included first in all compiled C and
+        C++ files.
+        If unity is given, C and C++ source files are compiled in
+        batches of that many files with the same extension (and at
+        most unity_size bytes if given), by generated sources in the
+        build directory that include them.  Assembly files are
+        compiled separately.  With unity_size, the stats of the
+        source files are inputs of the generation, so the build is
+        regenerated, and the files rebatched, when a source changes.
         """
-        src = hb.pathset(src)
+        src = hb.listfile("gcc.list") if src is None else hb.pathset(src)
         hfiles, cfiles, ofiles, afiles, cffiles, ldffiles, ldsc = hb.filter(
             src,
             r"\.h$",
@@ -27,9 +104,135 @@ def build(hb):
             r"\.ld$",
         )
         dirs = hb.directories(src)
-        incp = " ".join(f"-I{p}" for p in hb.relative(dirs))
+        incp = " ".join(f"-I{p}" for p in hb.relative(hb.cwd, dirs))
         opath = hb.root + "/build/gcc"
+        if launcher:
+            vars["launcher"] = launcher
+        if unity:
+            cfiles = gcc_unity(cfiles, opath, unity, unity_size)
+        pchs = {}
+        new_ofiles = []
+        for cfile in cfiles:
+            stem, ext = splitext(basename(cfile))
+            ofile = f"{opath}/{stem}.o"
+            deps = {}
+            cvars = vars
+            language = _pch_languages.get(ext)
+            if pch and language:
+                if language not in pchs:
+                    pchs[language] = gcc_pch(
+                        pch, opath, language, incp=incp, **vars
+                    )
+                deps, flags = pchs[language]
+                cvars = {**vars, "pch": flags}
+            if dyndep:
+                gcc_dd(cfile, ofile, hfiles, deps, incp=incp, **cvars)
+            else:
+                hb.build(
+                    gcc,
+                    ofile,
+                    cfile,
+                    deps=deps,
+                    oodeps=hfiles,
+                    incp=incp,
+                    **cvars,
+                )
+            new_ofiles.append(ofile)
+        return hb.pathset(ofiles, new_ofiles)
+
+    @hb.rule(_command, depfile=True)
+    def gcc_dd(cfile, ofile, hfiles, deps, **vars):
+        """
+        Compile C file, with the generated headers it includes
+        read from a ninja dyndep file.
+        """
+        ddfile = f"{ofile}.dd"
+        scan_vars = {
+            k: v for k, v in vars.items() if k not in ("launcher", "pch")
+        }
+        gcc_scan(cfile, ddfile, ofile, **scan_vars)
+        (dyndep,) = hb.relative(hb.cwd, hb.pathset(ddfile))
+        hb.build(
+            gcc_dd,
+            ofile,
+            cfile,
+            deps=deps,
+            oodeps=hb.pathset(hfiles, ddfile),
+            dyndep=dyndep,
+            **vars,
+        )
+
+    @hb.rule(_scan_command, callback=_scan_callback, depfile=True)
+    def gcc_scan(cfile, ddfile, ofile, **vars):
+        """
+        Scan C file for included generated headers.
+        """
+        (obj,) = hb.relative(hb.cwd, hb.pathset(ofile))
+        hb.build(gcc_scan, ddfile, cfile, obj=obj, **vars)
+
+    @hb.rule(_pch_command, depfile=True)
+    def gcc_pch(header, opath, language, **vars):
+        """
+        Precompile header as the given language (c-header or
+        c++-header), with the same flags as the files it is included
+        in.  The header is included from a wrapper file in the build
+        directory, where the precompiled header is written, one per
+        header, language and set of flags.  The wrapper is not named
+        .h, so that it is not taken for a generated header.  The
+        header is compiled without waiting for generated headers, so
+        it shall not include any.  gcc() calls with the same header
+        and flags create identical builds, written once.
+        Return the precompiled header, and the flags that use it.
+        """
+        (header,) = hb.pathset(header)
+        flags = {k: v for k, v in vars.items() if k != "launcher"}
+        key = repr((header, language, sorted(flags.items())))
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        wrapper = f"{opath}/pch/{digest}/{basename(header)}.inc"
+        gch = f"{wrapper}.gch"
+        gcc_pch_wrapper(header, wrapper)
+        hb.build(gcc_pch, gch, wrapper, language=language, **vars)
+        (rel,) = hb.relative(hb.cwd, hb.pathset(wrapper))
+        return gch, f"-include {rel} -Winvalid-pch"
+
+    @hb.rule(_wrapper_command)
+    def gcc_pch_wrapper(header, wrapper):
+        """
+        Write header that includes the given header.
+        """
+        header = relpath(header, dirname(wrapper))
+        hb.build(gcc_pch_wrapper, wrapper, header=header)
+
+    @hb.rule(_unity_command)
+    def gcc_unity(cfiles, opath, count, size=0):
+        """
+        Write sources that include batches of the given C files, one
+        set of batches per extension.  A source is named after the
+        first file in its batch, and a digest of the batch, so that
+        batches of different gcc() calls do not share a source.
+        Return the written sources, and the assembly files.
+        """
+        if size:
+            hb.prefetch(cfiles)
+        groups = {}
         for cfile in cfiles:
-            ofile = f"{opath}/{splitext(basename(cfile))[0]}.o"
-            hb.build(gcc, ofile, cfile, oodeps=hfiles, incp=incp, **vars)
-            ofiles.append(ofile)
+            groups.setdefault(splitext(cfile)[1], []).append(cfile)
+        sources = []
+        for ext, group in groups.items():
+            if ext not in _pch_languages:
+                sources += group
+                continue
+            for batch in _batches(hb, group, count, size):
+                stem = splitext(basename(batch[0]))[0]
+                digest = hashlib.sha1("\n".join(batch).encode())
+                digest = digest.hexdigest()[:8]
+                source = f"{opath}/unity/{stem}_unity_{digest}{ext}"
+                lines = " ".join(
+                    shlex.quote(
+                        f'#include "{relpath(cfile, dirname(source))}"'
+                    )
+                    for cfile in batch
+                )
+                hb.build(gcc_unity, source, lines=lines.replace("$", "$$"))
+                sources.append(source)
+        return hb.pathset(sources)
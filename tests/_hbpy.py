@@ -0,0 +1,16 @@
+"""hb.py file texts shared by the tests"""
+
+_copy = """
+def build(hb):
+    @hb.rule("cp $in $out")
+    def copy(src, dst):
+        hb.build(copy, dst, src)
+"""
+
+
+def copy_hbpy(*lines: str) -> str:
+    """Return text of hb.py file whose build() function defines a copy
+    rule, and then runs the given lines"""
+    if not lines:
+        return _copy
+    return _copy + "\n" + "".join(f"    {line}\n" for line in lines)
@@ -0,0 +1,62 @@
+import json
+import shutil
+import subprocess
+
+import pytest
+from click.testing import CliRunner
+
+from hb import cli
+
+from ._hbpy import copy_hbpy
+
+
+_hbpy = copy_hbpy('copy("a.txt", "b.txt")', 'copy("a.txt", "c.txt")')
+
+
+@pytest.fixture
+def tree(tmp_path, monkeypatch):
+    if not shutil.which("ninja"):
+        pytest.skip("ninja not available")
+    (tmp_path / ".hbroot").write_text("")
+    (tmp_path / "hb.py").write_text(_hbpy)
+    (tmp_path / "a.txt").write_text("a")
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def _main(*args):
+    return CliRunner().invoke(cli.main, args, catch_exceptions=False)
+
+
+def test_main(tree):
+    assert _main().exit_code == 0
+    assert (tree / "b.txt").read_text() == "a"
+    assert (tree / "c.txt").exists()
+    assert _main("--split").exit_code == 0
+    assert (tree / ".hb/ninja/top.ninja").exists()
+
+
+def test_main_target(tree):
+    assert _main("--target", "b.txt").exit_code == 0
+    assert (tree / "b.txt").exists()
+    assert not (tree / "c.txt").exists()
+
+
+def test_main_profile(tree):
+    assert _main().exit_code == 0
+    result = _main("--profile")
+    assert result.exit_code == 0
+    assert "hb.py files:" in result.output
+    with open(tree / ".hb/profile.json") as fh:
+        profile = json.load(fh)
+    assert list(profile["files"]) == [f"{tree}/hb.py"]
+    assert profile["builds"]["copy"]["calls"] == 2
+
+
+def test_main_gitindex(tree):
+    if not shutil.which("git"):
+        pytest.skip("git not available")
+    subprocess.run(["git", "init", "-q"], check=True)
+    subprocess.run(["git", "add", "."], check=True)
+    assert _main("--gitindex").exit_code == 0
+    assert (tree / "b.txt").exists()
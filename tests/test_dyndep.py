@@ -0,0 +1,69 @@
+import io
+import os.path as op
+import sys
+
+import hb
+from hb import _dyndep
+
+
+_gcc = op.join(op.dirname(hb.__file__), "rules", "_gcc.py")
+
+
+def test_parse_deps():
+    text = "a.o: a.c a.h \\\n  dir\\ x/b.h\nc.o: c.c\n"
+    assert _dyndep.parse_deps(text) == ["a.c", "a.h", "dir x/b.h", "c.c"]
+
+
+def test_generated():
+    headers = ["gen/a.h", "gen/sub/b.h", "c.h"]
+    deps = ["x.c", "a.h", "sub/b.h", "./c.h", "b.h", "other/a.h"]
+    found = _dyndep.generated(deps, headers)
+    assert found == ["gen/a.h", "gen/sub/b.h", "c.h"]
+    assert _dyndep.generated(["d.h", "ub/b.h"], headers) == []
+
+
+def test_main(tmp_path):
+    (tmp_path / "x.c").write_text("")
+    ddfile = tmp_path / "x.o.dd"
+    depfile = tmp_path / "x.o.dd.d"
+    output = f"x.o: {tmp_path}/x.c g.h"
+    command = [sys.executable, "-c", f"print({output!r})"]
+    genh = tmp_path / "genh"
+    genh.write_text("gen/g.h\ngen/h.h\n")
+    args = [str(ddfile), str(depfile), "x.o", str(genh)]
+    assert _dyndep.main(args + ["--"] + command) == 0
+    assert ddfile.read_text() == (
+        "ninja_dyndep_version = 1\nbuild x.o: dyndep | gen/g.h\n"
+    )
+    # Generated headers are not dependencies of the scan
+    assert depfile.read_text() == f"{ddfile}: {tmp_path}/x.c\n"
+    command = [sys.executable, "-c", "raise SystemExit(3)"]
+    assert _dyndep.main(args + ["--"] + command) == 3
+    assert _dyndep.main(args) == 2
+
+
+def test_genh(tmp_path):
+    (tmp_path / ".hbroot").write_text("")
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src/a.c").write_text("")
+    context = hb.context(str(tmp_path))
+    hb.read.load_and_run(context, _gcc)
+
+    @context.rule("touch $out")
+    def gen(dst):
+        context.build(gen, dst)
+
+    gen("gen/g.h")
+    context.gcc("src/*.c", dyndep=True)
+    fh = io.StringIO()
+    context.write_ninja(fh)
+    genh = tmp_path / ".hb/gcc_scan.genh"
+    assert genh.read_text() == "gen/g.h\n"
+    rule = fh.getvalue().split("rule gcc_scan\n")[1].split("\n\n")[0]
+    assert ".hb/gcc_scan.genh" in rule
+    assert "gen/g.h" not in rule
+    context = hb.context(str(tmp_path))
+    hb.read.load_and_run(context, _gcc)
+    context.gcc("src/*.c", dyndep=True)
+    context.write_ninja(io.StringIO())
+    assert genh.read_text() == ""
@@ -0,0 +1,149 @@
+import hb
+
+import io
+import os.path as op
+import re
+
+
+_gcc = op.join(op.dirname(hb.__file__), "rules", "_gcc.py")
+
+
+def _context(tmp_path):
+    (tmp_path / ".hbroot").write_text("")
+    (tmp_path / "src").mkdir()
+    for name in ("a.c", "b.c", "common.h"):
+        (tmp_path / "src" / name).write_text("")
+    context = hb.context(str(tmp_path))
+    hb.read.load_and_run(context, _gcc)
+    return context
+
+
+def _names(paths):
+    """Return base names of paths, without unity batch digests"""
+    return [re.sub(r"_[0-9a-f]{8}\.", ".", op.basename(p)) for p in paths]
+
+
+def test_launcher(tmp_path):
+    context = _context(tmp_path)
+    context.gcc("src/*.c", launcher="ccache")
+    fh = io.StringIO()
+    context.write_ninja(fh)
+    text = fh.getvalue()
+    assert "command = ${gcc_launcher} gcc " in text
+    assert text.count("gcc_launcher = ccache") == 2
+
+
+def test_pch(tmp_path):
+    context = _context(tmp_path)
+
+    @context.rule("touch $out")
+    def gen(dst):
+        context.build(gen, dst)
+
+    gen("gen.h")
+    context.gcc("src/a.c", pch="src/common.h", cflags="-O2")
+    context.gcc("src/b.c", pch="src/common.h", cflags="-O2")
+    context.gcc("src/b.c", pch="src/common.h", cflags="-O0")
+    pchs = [b for b in context._builds if b.rule == "gcc_pch"]
+    wrappers = [b for b in context._builds if b.rule == "gcc_pch_wrapper"]
+    assert len(pchs) == len(wrappers) == 3
+    assert pchs[0].dst == pchs[1].dst != pchs[2].dst
+    fh = io.StringIO()
+    context.write_ninja(fh)
+    text = fh.getvalue()
+    # Identical builds of the shared precompiled header are written once
+    assert text.count(": gcc_pch ") == text.count(": gcc_pch_wrapper") == 2
+    # Objects wait for generated headers, precompiled headers do not
+    edges = text.split("\nbuild ")
+    assert all("gen.h" in x for x in edges if ": gcc " in x)
+    assert not any("gen.h" in x for x in edges if ": gcc_pch " in x)
+    (gch,) = pchs[0].dst
+    (wrapper,) = pchs[0].src
+    assert gch == f"{wrapper}.gch"
+    assert wrappers[0].vars["header"] == "../../../../src/common.h"
+    objects = [b for b in context._builds if b.rule == "gcc"]
+    assert gch in objects[0].deps and gch in objects[1].deps
+    rel = op.relpath(wrapper, str(tmp_path))
+    assert objects[0].vars["pch"] == f"-include {rel} -Winvalid-pch"
+    assert pchs[0].vars["language"] == "c-header"
+    # The wrapper is not taken for a generated header
+    headers = context.filter(context.targets, r"\.h$")
+    assert list(headers) == [str(tmp_path / "gen.h")]
+
+
+def test_pch_languages(tmp_path):
+    context = _context(tmp_path)
+    for name in ("c.cc", "d.cpp", "e.S"):
+        (tmp_path / "src" / name).write_text("")
+    context.gcc("src/[a-e].*", pch="src/common.h")
+    pchs = [b for b in context._builds if b.rule == "gcc_pch"]
+    assert [b.vars["language"] for b in pchs] == ["c-header", "c++-header"]
+    objects = {
+        op.basename(*b.dst): b for b in context._builds if b.rule == "gcc"
+    }
+    assert objects["c.o"].deps == objects["d.o"].deps != objects["a.o"].deps
+    assert "pch" in objects["d.o"].vars
+    assert not objects["e.o"].deps and "pch" not in objects["e.o"].vars
+
+
+def test_unity(tmp_path):
+    context = _context(tmp_path)
+    for i in range(5):
+        (tmp_path / "src" / f"c{i}.c").write_text("x" * 10)
+    context.gcc("src/c*.c", unity=2)
+    sources = [b for b in context._builds if b.rule == "gcc_unity"]
+    objects = [b for b in context._builds if b.rule == "gcc"]
+    assert [len(b.vars["lines"].split("' '")) for b in sources] == [2, 2, 1]
+    assert sources[0].vars["lines"] == (
+        "'#include \"../../../src/c0.c\"' '#include \"../../../src/c1.c\"'"
+    )
+    assert _names(p for b in objects for p in b.dst) == [
+        "c0_unity.o",
+        "c2_unity.o",
+        "c4_unity.o",
+    ]
+    assert list(objects[0].src) == list(sources[0].dst)
+    # Batches of other gcc() calls get other sources
+    (tmp_path / "lib").mkdir()
+    (tmp_path / "lib" / "c0.c").write_text("")
+    context.gcc("lib/c0.c", unity=2)
+    sources = [b for b in context._builds if b.rule == "gcc_unity"]
+    assert _names(sources[3].dst) == _names(sources[0].dst)
+    assert sources[3].dst != sources[0].dst
+
+
+def test_unity_size(tmp_path):
+    context = _context(tmp_path)
+    for i, size in enumerate((10, 10, 25, 5, 5)):
+        (tmp_path / "src" / f"c{i}.c").write_text("x" * size)
+    context.gcc("src/c*.c", unity=10, unity_size=20)
+    sources = [b for b in context._builds if b.rule == "gcc_unity"]
+    assert [len(b.vars["lines"].split("' '")) for b in sources] == [2, 1, 2]
+
+
+def test_unity_languages(tmp_path):
+    context = _context(tmp_path)
+    for name in ("c.cc", "d.cc", "e.S", "f.s"):
+        (tmp_path / "src" / name).write_text("")
+    context.gcc("src/[a-f].*", unity=8)
+    sources = [b for b in context._builds if b.rule == "gcc_unity"]
+    assert _names(p for b in sources for p in b.dst) == [
+        "a_unity.c",
+        "c_unity.cc",
+    ]
+    assert "d.cc" in sources[1].vars["lines"]
+    objects = [b for b in context._builds if b.rule == "gcc"]
+    assert sorted(_names(p for b in objects for p in b.src)) == [
+        "a_unity.c",
+        "c_unity.cc",
+        "e.S",
+        "f.s",
+    ]
+
+
+def test_gcc_list(tmp_path):
+    context = _context(tmp_path)
+    (tmp_path / "gcc.list").write_text("src/a.c\nsrc/common.h\n")
+    context.gcc()
+    objects = [b for b in context._builds if b.rule == "gcc"]
+    assert [op.basename(*b.dst) for b in objects] == ["a.o"]
@@ -0,0 +1,56 @@
+import hb
+
+import os
+import pytest
+import shutil
+import subprocess
+
+
+def _git(cwd, *args):
+    subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True)
+
+
+@pytest.fixture(params=[2, 4])
+def worktree(tmp_path, request):
+    if not shutil.which("git"):
+        pytest.skip("git not available")
+    for path in (".hbroot", "hb.py", "a.c", "sub/b.c", "sub/deep/c.c"):
+        os.makedirs(tmp_path / os.path.dirname(path), exist_ok=True)
+        (tmp_path / path).write_text("")
+    _git(tmp_path, "init", "-q")
+    _git(tmp_path, "add", ".")
+    _git(tmp_path, "update-index", "--index-version", str(request.param))
+    (tmp_path / "untracked.c").write_text("")
+    (tmp_path / "sub/untracked.c").write_text("")
+    return str(tmp_path)
+
+
+def test_gitindex(worktree):
+    context = hb.context(worktree, gitindex=True)
+    assert list(context.pathset("**/*.c")) == [
+        f"{worktree}/a.c",
+        f"{worktree}/sub/b.c",
+        f"{worktree}/sub/deep/c.c",
+    ]
+    assert context.exists(f"{worktree}/sub/b.c")
+    assert context.isdir(f"{worktree}/sub/deep")
+    assert not context.exists(f"{worktree}/untracked.c")
+    assert context.stat(f"{worktree}/a.c").st_size == 0
+
+
+def test_gitindex_scan(worktree):
+    context = hb.context(worktree, gitindex=True)
+    files, _ = hb.read.scan(
+        {f"{worktree}/sub/deep": True}, exists=context.exists
+    )
+    assert list(files) == [f"{worktree}/hb.py"]
+    assert context._index.filename in context._consulted
+
+
+def test_gitindex_generate(worktree):
+    with open(f"{worktree}/hb.py", "w") as fh:
+        fh.write("def build(hb):\n    pass\n")
+    assert hb.context(worktree).generate()
+    assert not hb.context(worktree).generate()
+    assert hb.context(worktree, gitindex=True).generate()
+    assert not hb.context(worktree, gitindex=True).generate()
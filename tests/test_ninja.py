@@ -0,0 +1,58 @@
+import io
+import os
+import ninja
+import pytest
+
+from hb import _ninja
+
+
+def _write(writer_class):
+    fh = io.StringIO()
+    w = writer_class(fh)
+    w.comment("A comment that is long enough to be wrapped " * 4)
+    w.variable("builddir", ".hb")
+    w.variable("flags", ["-O2", "", "-g"])
+    w.variable("none", None)
+    w.pool("link_pool", 2)
+    w.rule("cc", "gcc -c $in -o $out " + "-Ifoo " * 20, depfile="$out.d")
+    w.newline()
+    w.build([], "phony")
+    w.build("x", "phony", "")
+    w.build(["a b", ""], "phony", ["", "c:d"], implicit=[], order_only="")
+    w.build("a.o", "cc", "a.c", variables={"opts": "-O3"})
+    w.build(
+        ["dir with space/b.o", "c:o"],
+        "cc",
+        ["x$ y.c"] + [f"src/file{i}.c" for i in range(20)],
+        implicit=["h.h"],
+        order_only="gen",
+        implicit_outputs=["b.d"],
+        pool="link_pool",
+        dyndep="dd",
+        variables=[("v", "1"), ("w", None)],
+    )
+    w.build("long", "cc", "x" * 100 + " " + "$ " * 60 + "y")
+    w.include("inc.ninja")
+    w.subninja("sub.ninja")
+    w.default(["a.o", "long"])
+    if isinstance(w, _ninja.Writer):
+        w.flush()
+    return fh.getvalue()
+
+
+def test_identical():
+    assert _write(_ninja.Writer) == _write(ninja.Writer)
+
+
+def test_atomic_open(tmp_path):
+    path = tmp_path / "build.ninja"
+    path.write_text("old")
+    with pytest.raises(RuntimeError):
+        with _ninja.atomic_open(str(path)) as fh:
+            fh.write("new")
+            raise RuntimeError()
+    assert path.read_text() == "old"
+    with _ninja.atomic_open(str(path)) as fh:
+        fh.write("new")
+    assert path.read_text() == "new"
+    assert os.listdir(tmp_path) == ["build.ninja"]
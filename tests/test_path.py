@@ -2,6 +2,7 @@ import hb
 from hb import path
 
 import os
+import re
 import os.path as op
 import pytest
 import time
@@ -204,3 +205,139 @@ def test_exists():
     # Try again, to make sure cached values are working
     assert not context.exists("/a/file/that/does/not/exist")
     assert context.exists(p)
+
+
+def test_glob():
+    context = hb.context(_this)
+    _assert_paths(
+        context.pathset("files/*.bar", "files/sub*/foo.bar"),
+        ["files/foo.bar", "files/subdir/foo.bar"],
+    )
+    _assert_paths(
+        context.pathset("files/**/hb.py"),
+        [
+            "files/hb.py",
+            "files/subdir/hb.py",
+            "files/subdir2/bar/hb.py",
+            "files/subdir2/foo/hb.py",
+        ],
+    )
+    _assert_paths(
+        context.pathset("files/subdir2/?o?/[xz].*"),
+        [
+            "files/subdir2/foo/x.y",
+            "files/subdir2/foo/z.w",
+        ],
+    )
+    assert context.pathset("files/*.nothing") == {}
+    misses = context.misses
+    assert context.exists(f"{_this}/files/subdir2/foo/x.y")
+    assert not context.exists(f"{_this}/files/subdir2/foo/x.z")
+    assert context.misses == misses + 2
+    assert f"{_this}/files/subdir2" in context._listing
+
+
+def test_prefetch(tmp_path, monkeypatch):
+    (tmp_path / ".hbroot").write_text("")
+    for n in range(20):
+        (tmp_path / f"{n}.c").write_text("")
+    context = hb.context(str(tmp_path))
+    pset = context.pathset([f"{n}.c" for n in range(20)], "nonexistent.c")
+    context.prefetch(pset)
+    assert context.misses == 21
+    assert not context.exists(f"{tmp_path}/nonexistent.c")
+    assert context.isdir(str(tmp_path))
+    assert context.misses == 22
+    assert context.hits == 1
+    context = hb.context(str(tmp_path))
+    monkeypatch.setattr(path, "_PREFETCH_THRESHOLD", 10)
+    assert len(context.files(pset)) == 21
+    assert context.misses == 21
+    assert context.hits == 21
+
+
+def test_shared_cache(tmp_path):
+    (tmp_path / ".hbroot").write_text("")
+    (tmp_path / "a.c").write_text("")
+    cache = hb.FsCache()
+    context = hb.context(str(tmp_path), cache=cache)
+    assert list(context.pathset("*.c")) == [f"{tmp_path}/a.c"]
+    assert context.exists(f"{tmp_path}/a.c")
+    assert context.misses == 1
+    (tmp_path / "b.c").write_text("")
+    context = hb.context(str(tmp_path), cache=cache)
+    assert context.root == str(tmp_path)
+    assert list(context.pathset("*.c")) == [f"{tmp_path}/a.c"]
+    assert context.exists(f"{tmp_path}/a.c")
+    assert context.misses == 0
+    cache.invalidate(f"{tmp_path}/b.c")
+    assert len(context.pathset("*.c")) == 2
+    cache.invalidate()
+    assert not cache.stats and not cache.listings and not cache.roots
+
+
+def test_canonical_memo(monkeypatch):
+    context = hb.context(_this)
+    monkeypatch.setattr(path, "_CANON_CACHE_SIZE", 2)
+    assert context.canonical("a/../b") == f"{_this}/b"
+    assert context.canonical("a/../b") == f"{_this}/b"
+    assert context.canonical("$root/c") == f"{_this}/c"
+    assert (context.canon_hits, context.canon_misses) == (1, 2)
+    context.anchor = f"{_this}/files"
+    assert context.canonical("a/../b") == f"{_this}/files/b"
+    assert len(context._canon_cache) == 2
+    assert (_this, _this, "a/../b") not in context._canon_cache
+
+
+def test_listfile():
+    context = hb.context(_this)
+    expected = [
+        "files/lists/foo.bar",
+        "files/bar.foo",
+        "files/subdir/foo.bar",
+    ]
+    plain = "files/lists/plain.list"
+    _assert_paths(context.listfile(plain), expected)
+    _assert_paths(context.pathset(plain), [plain])
+    _assert_paths(
+        context.listfile("files/lists/nested.list"),
+        [plain, "files/subdir2/foo/z.w", "files/bar.foo"],
+    )
+    assert f"{_this}/files/lists/plain.list" in context._list_cache
+
+
+def test_filter_suffix():
+    context = hb.context(_this)
+    patterns = (r"\.h$", r"\.(c|cc)$", r"\.o$", r"/x\.", r"\.tar\.gz$")
+    pset = context.pathset(
+        "a.h", "b.c", "c.cc", "d.h.o", "e.ch", "x.c", "f.h/g", "h.tar.gz", "i"
+    )
+    expected = tuple(
+        [p for p in pset if re.search(pattern, p)] for pattern in patterns
+    )
+    result = context.filter(pset, *patterns)
+    assert tuple(list(x) for x in result) == expected
+    assert list(context.filter({f"{_this}/y.h": True}, r"\.h$")) == [
+        f"{_this}/y.h"
+    ]
+
+
+def test_relative_memo():
+    context = hb.context(_this)
+    paths = [
+        "/",
+        "/x",
+        f"{_this}",
+        f"{_this}/files",
+        f"{_this}/files/subdir",
+        f"{_this}/files/subdir/ping",
+        f"{_this}/files/subdir/ping/pong",
+        f"{_this}/files/subdir/pingpong",
+        f"{_this}/files/sub",
+        f"{_this}/other/x.c",
+    ]
+    frompath = f"{_this}/files/subdir/ping"
+    expected = [op.relpath(p, frompath) for p in paths]
+    assert context.relative(frompath, paths) == expected
+    assert context.relative(frompath, paths) == expected
+    assert context.relative("/", paths) == [op.relpath(p, "/") for p in paths]
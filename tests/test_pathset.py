@@ -0,0 +1,57 @@
+import hb
+from hb._pathset import PathSet
+
+import os.path as op
+import pytest
+
+
+_this = op.normpath(op.abspath(op.dirname(__file__)))
+
+
+def test_pathset():
+    pset = PathSet(["/b", "/a", "/b", "/c"])
+    assert list(pset) == ["/b", "/a", "/c"]
+    assert len(pset) == 3
+    assert "/a" in pset and "/d" not in pset
+    assert pset == {"/a": True, "/b": True, "/c": True}
+    assert list(pset | PathSet(["/d", "/a"])) == ["/b", "/a", "/c", "/d"]
+    with pytest.raises(TypeError):
+        pset | ["/d"]
+    assert {**pset} == dict(pset)
+    large = PathSet(f"/{n}" for n in range(100))
+    assert "/99" in large and "/100" not in large
+
+
+def test_pathset_sharing():
+    context = hb.context(_this)
+    hfiles = context.pathset("a.h", "b.h")
+    assert context.pathset(hfiles) is hfiles
+
+    @context.rule("cc -c $in -o $out")
+    def cc(*cfiles):
+        for cfile in context.pathset(cfiles):
+            context.build(cc, f"{cfile}.o", cfile, oodeps=hfiles)
+
+    cc("a.c", "b.c")
+    assert all(b.oodeps is hfiles for b in context._builds)
+
+
+def test_lazy_composition():
+    context = hb.context(_this)
+    base = context.pathset("a.c", "b.c")
+    chain = [base]
+    for n in range(2000):
+        chain.append(context.pathset(chain[-1], f"{n % 10}.c", base))
+    top = chain[-1]
+    assert all(p._ids is None for p in chain[1:])
+    assert list(top.walk())[:3] == [
+        f"{_this}/a.c",
+        f"{_this}/b.c",
+        f"{_this}/0.c",
+    ]
+    assert chain[-2]._ids is None
+    assert len(top) == 12
+    assert top._ids is not None and chain[-2]._ids is None
+    assert f"{_this}/9.c" in top
+    assert bool(chain[-2]) and not bool(context.pathset())
+    assert list(base | top) == list(top)
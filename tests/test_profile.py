@@ -0,0 +1,42 @@
+import json
+
+import hb
+from hb import _profile
+
+from ._hbpy import copy_hbpy
+
+
+# Not ASCII, so that bytes and characters written differ
+_top_hbpy = copy_hbpy('copy("lib/@src", "b\u00e9.txt")')
+
+_lib_hbpy = """
+def build(hb):
+    hb.copy("a.txt", "x.txt")
+    hb.export("src", "x.txt")
+"""
+
+
+def test_profile(tmp_path):
+    (tmp_path / ".hbroot").write_text("")
+    (tmp_path / "hb.py").write_text(_top_hbpy)
+    (tmp_path / "lib").mkdir()
+    (tmp_path / "lib/hb.py").write_text(_lib_hbpy)
+    context = hb.context(str(tmp_path), profile=True)
+    context.generate()
+    profile = context.profile
+    top = profile.files[f"{tmp_path}/hb.py"]
+    lib = profile.files[f"{tmp_path}/lib/hb.py"]
+    assert top.calls == lib.calls == 1
+    assert top.total > lib.total
+    assert top.self < top.total - lib.total + 1e-6
+    assert profile.rules["copy"].calls == 2
+    assert profile.builds["copy"].calls == 2
+    ninja = (tmp_path / "build.ninja").read_bytes()
+    assert profile.bytes_written == len(ninja)
+    data = json.loads(json.dumps(_profile.as_dict(context)))
+    assert data["rules"]["copy"]["calls"] == 2
+    assert data["stat_cache"]["hits"] == context.hits
+    report = _profile.report(context)
+    assert "lib/hb.py" in report
+    assert f"Ninja bytes written: {len(ninja)}" in report
+    assert hb.context(str(tmp_path)).profile is None
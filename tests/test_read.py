@@ -2,6 +2,7 @@ import hb
 from hb import path
 from hb import read
 
+import os
 import os.path as op
 
 
@@ -33,3 +34,59 @@ def test_scan():
         f"{_this}/files/nonexistent/directory",
         f"{_this}/files/nonexistent",
     ]
+
+
+def test_scan_in_place():
+    scanned = {}
+    subdir = f"{_this}/files/subdir"
+    files, result = read.scan([subdir], scanned=scanned)
+    assert result is scanned
+    assert files == {f"{subdir}/hb.py": True}
+    files, _ = read.scan([subdir], scanned=scanned)
+    assert files == {}
+
+
+def test_scan_owners(tmp_path):
+    (tmp_path / "hb.py").write_text("")
+    root = tmp_path / "root"
+    (root / "a").mkdir(parents=True)
+    (root / ".hbroot").write_text("")
+    (root / "a/hb.py").write_text("")
+    lookups = []
+
+    def exists(path):
+        lookups.append(path)
+        return op.exists(path)
+
+    scanned = {}
+    files, _ = read.scan([f"{root}/b"], scanned=scanned, exists=exists)
+    assert files == {}
+    assert scanned == {f"{root}/b": "", f"{root}": ""}
+    files, _ = read.scan([f"{root}/a/x"], scanned=scanned, exists=exists)
+    assert files == {f"{root}/a/hb.py": True}
+    assert scanned[f"{root}/a/x"] == f"{root}/a/hb.py"
+    del lookups[:]
+    files, _ = read.scan([f"{root}/a/y"], scanned=scanned, exists=exists)
+    assert files == {}
+    assert scanned[f"{root}/a/y"] == f"{root}/a/hb.py"
+    assert lookups == [f"{root}/a/y/hb.py", f"{root}/a/y/.hbroot"]
+
+
+def test_bytecode_cache(tmp_path):
+    file = tmp_path / "hb.py"
+    cache = str(tmp_path / "cache")
+    file.write_text("x = 1\n")
+    st = os.stat(file)
+    mod = read.load(str(file), cache)
+    assert mod.x == 1
+    assert mod.__file__ == str(file)
+    assert len(os.listdir(cache)) == 1
+    # Same stats, the cached code is used
+    file.write_text("x = 2\n")
+    os.utime(file, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert read.load(str(file), cache).x == 1
+    file.write_text("x = 33\n")
+    assert read.load(str(file), cache).x == 33
+    other = tmp_path / "sub.py"
+    other.write_text("")
+    assert read.load(str(other), cache).__name__ != mod.__name__
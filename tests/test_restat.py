@@ -0,0 +1,38 @@
+import os
+
+from hb import _restat
+
+
+def test_main(tmp_path):
+    database = str(tmp_path / "db")
+    out = tmp_path / "out.txt"
+    cmdfile = tmp_path / "cmd"
+    cmdfile.write_text(f"echo a > {out}\n")
+    args = [database, str(cmdfile), str(out)]
+    assert _restat.main(args) == 0
+    assert out.read_text() == "a\n"
+    os.utime(out, ns=(0, 1000))
+    assert _restat.main(args) == 0
+    assert out.stat().st_mtime_ns == 1000
+    cmdfile.write_text(f"echo b > {out}\n")
+    assert _restat.main(args) == 0
+    assert out.read_text() == "b\n"
+    assert out.stat().st_mtime_ns != 1000
+    cmdfile.write_text("exit 3\n")
+    assert _restat.main(args) == 3
+    assert _restat.main(args[:2]) == 2
+
+
+def test_before(tmp_path):
+    database = str(tmp_path)
+    out = tmp_path / "out.txt"
+    assert _restat.before(database, str(out)) == ("", 0)
+    out.write_text("a")
+    digest, mtime = _restat.before(database, str(out))
+    assert mtime == out.stat().st_mtime_ns
+    _restat.after(database, str(out), "", 0)
+    # The stored hash is used while the modification time is unchanged
+    entry = _restat._entry(database, str(out))
+    with open(entry, "w") as fh:
+        fh.write(f"stored {mtime}\n")
+    assert _restat.before(database, str(out)) == ("stored", mtime)
@@ -1,9 +1,15 @@
 import hb
+from hb import _rule
 
+import io
+import json
 import os
 import os.path as op
+import sys
 import pytest
 
+from ._hbpy import copy_hbpy
+
 _this = op.normpath(op.abspath(op.dirname(__file__)))
 
 
@@ -109,3 +115,436 @@ def test_build_scan():
     scanner(f"{_this}/files/floppy.txt", f"{_this}/files/test1.list")
     assert context.floppydisk == 3
     assert context.subdir
+
+
+_hbpy = copy_hbpy('copy("sub/a.txt", "b.txt")')
+
+
+def test_generate(tmp_path):
+    (tmp_path / ".hbroot").write_text("")
+    (tmp_path / "hb.py").write_text(_hbpy)
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub/a.txt").write_text("a")
+    ninja = tmp_path / "build.ninja"
+    assert hb.context(str(tmp_path)).generate()
+    assert "build b.txt: copy sub/a.txt" in ninja.read_text()
+    assert not hb.context(str(tmp_path)).generate()
+    (tmp_path / "sub/hb.py").write_text("")
+    assert hb.context(str(tmp_path)).generate()
+    assert not hb.context(str(tmp_path)).generate()
+    (tmp_path / "hb.py").write_text(_hbpy.replace("b.txt", "c.txt"))
+    assert hb.context(str(tmp_path)).generate()
+    assert "build c.txt: copy sub/a.txt" in ninja.read_text()
+    ninja.unlink()
+    assert hb.context(str(tmp_path)).generate()
+    (tmp_path / "sub/x.txt").write_text("")
+    assert not hb.context(str(tmp_path)).generate()
+    assert hb.context(str(tmp_path)).generate(key="other")
+
+
+def test_generate_imported(tmp_path):
+    (tmp_path / ".hbroot").write_text("")
+    (tmp_path / "hb.py").write_text(
+        "import hbtest_out\n" + _hbpy.replace('"b.txt"', "hbtest_out.OUT")
+    )
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub/a.txt").write_text("a")
+    out = tmp_path / "hbtest_out.py"
+    out.write_text('OUT = "b.txt"\n')
+    try:
+        assert hb.context(str(tmp_path)).generate()
+        assert not hb.context(str(tmp_path)).generate()
+        del sys.modules["hbtest_out"]
+        out.write_text('OUT = "cc.txt"\n')
+        assert hb.context(str(tmp_path)).generate()
+        ninja = (tmp_path / "build.ninja").read_text()
+        assert "build cc.txt: copy sub/a.txt" in ninja
+    finally:
+        sys.modules.pop("hbtest_out", None)
+
+
+def test_generate_hb_changed(tmp_path, monkeypatch):
+    (tmp_path / ".hbroot").write_text("")
+    (tmp_path / "hb.py").write_text(_hbpy)
+    assert hb.context(str(tmp_path)).generate()
+    assert not hb.context(str(tmp_path)).generate()
+    monkeypatch.setattr(hb._manifest, "_hb_digest", lambda: "other")
+    assert hb.context(str(tmp_path)).generate()
+
+
+_probe_hbpy = """
+def build(hb):
+    extra = hb.exists(hb.canonical("extra.txt"))
+    src = "extra.txt" if extra else "a.txt"
+    hb.copy(src, "x.txt")
+    hb.export("src", "x.txt")
+"""
+
+
+def test_generate_probed(tmp_path):
+    (tmp_path / ".hbroot").write_text("")
+    (tmp_path / "hb.py").write_text(_top_hbpy)
+    (tmp_path / "lib").mkdir()
+    (tmp_path / "lib/hb.py").write_text(_probe_hbpy)
+    ninja = tmp_path / "build.ninja"
+    assert hb.context(str(tmp_path)).generate()
+    assert "build lib/x.txt: copy lib/a.txt" in ninja.read_text()
+    assert not hb.context(str(tmp_path)).generate()
+    (tmp_path / "lib/extra.txt").write_text("")
+    assert hb.context(str(tmp_path)).generate()
+    assert "build lib/x.txt: copy lib/extra.txt" in ninja.read_text()
+    # The probe is recorded by the replayed hb.py file too
+    ninja.unlink()
+    context = hb.context(str(tmp_path))
+    assert context.generate()
+    assert context._evalcache.replayed == 1
+    assert not hb.context(str(tmp_path)).generate()
+    (tmp_path / "lib/extra.txt").unlink()
+    assert hb.context(str(tmp_path)).generate()
+    assert "build lib/x.txt: copy lib/a.txt" in ninja.read_text()
+
+
+_top_hbpy = copy_hbpy('copy("lib/@src", "b.txt")')
+
+_lib_hbpy = """
+def build(hb):
+    hb.lib = "{name}"
+    hb.copy("a.txt", "{name}.txt")
+    hb.export("src", "{name}.txt")
+"""
+
+
+def test_evalcache(tmp_path):
+    (tmp_path / ".hbroot").write_text("")
+    (tmp_path / "hb.py").write_text(_top_hbpy)
+    (tmp_path / "lib").mkdir()
+    (tmp_path / "lib/hb.py").write_text(_lib_hbpy.format(name="x"))
+    ninja = tmp_path / "build.ninja"
+    context = hb.context(str(tmp_path))
+    context.generate()
+    assert context._evalcache.executed == 2
+    expected = ninja.read_text()
+    ninja.unlink()
+    context = hb.context(str(tmp_path))
+    context.generate()
+    assert context._evalcache.executed == 1
+    assert context._evalcache.replayed == 1
+    assert context.lib == "x"
+    assert ninja.read_text() == expected
+    (tmp_path / "lib/hb.py").write_text(_lib_hbpy.format(name="y"))
+    context = hb.context(str(tmp_path))
+    context.generate()
+    assert context._evalcache.executed == 2
+    assert "build b.txt: copy lib/y.txt" in ninja.read_text()
+
+
+_shared_hbpy = """
+def build(hb):
+    headers = hb.pathset("a.h", "b.h")
+    for name in ("x", "y", "z"):
+        hb.build(hb.copy, f"{name}.o", f"{name}.c", deps=headers)
+    hb.export("src", "x.o", "y.o", "z.o")
+"""
+
+
+def test_evalcache_pathsets(tmp_path):
+    (tmp_path / ".hbroot").write_text("")
+    (tmp_path / "hb.py").write_text(_top_hbpy)
+    (tmp_path / "lib").mkdir()
+    (tmp_path / "lib/hb.py").write_text(_shared_hbpy)
+    ninja = tmp_path / "build.ninja"
+    hb.context(str(tmp_path)).generate()
+    expected = ninja.read_text()
+    with open(tmp_path / ".hb/evalcache.json") as fh:
+        data = json.load(fh)
+    pathsets = data["pathsets"]
+    assert len(pathsets) == len({json.dumps(p) for p in pathsets})
+    (entry,) = data["entries"].values()
+    assert len({build[3] for build in entry["builds"]}) == 1
+    ninja.unlink()
+    context = hb.context(str(tmp_path))
+    context.generate()
+    assert context._evalcache.replayed == 1
+    assert ninja.read_text() == expected
+    assert len({id(b.deps) for b in context._builds if b.deps}) == 1
+
+
+_rules_hbpy = copy_hbpy()
+
+_attr_hbpy = """
+def build(hb):
+    import hb as hbmod
+
+    hbmod.read.load_and_run(hb, hb.root + "/rules/hb.py")
+    hb.out = "{name}"
+    hb.copy("lib/@src", "b.txt")
+"""
+
+_attr_lib_hbpy = """
+def build(hb):
+    hb.copy("a.txt", hb.out)
+    hb.export("src", hb.out)
+"""
+
+
+def test_evalcache_attrs(tmp_path):
+    (tmp_path / ".hbroot").write_text("")
+    (tmp_path / "hb.py").write_text(_attr_hbpy.format(name="x.txt"))
+    (tmp_path / "rules").mkdir()
+    (tmp_path / "rules/hb.py").write_text(_rules_hbpy)
+    (tmp_path / "lib").mkdir()
+    (tmp_path / "lib/hb.py").write_text(_attr_lib_hbpy)
+    ninja = tmp_path / "build.ninja"
+    hb.context(str(tmp_path)).generate()
+    (tmp_path / "hb.py").write_text(_attr_hbpy.format(name="x.txt") + "#")
+    context = hb.context(str(tmp_path))
+    context.generate()
+    assert context._evalcache.replayed == 1
+    (tmp_path / "hb.py").write_text(_attr_hbpy.format(name="yy.txt"))
+    context = hb.context(str(tmp_path))
+    context.generate()
+    assert context._evalcache.replayed == 0
+    assert "build b.txt: copy lib/yy.txt" in ninja.read_text()
+
+
+_import_lib_hbpy = """
+import hbtest_names
+
+
+def build(hb):
+    hb.copy("a.txt", hbtest_names.OUT)
+    hb.export("src", hbtest_names.OUT)
+"""
+
+
+def test_evalcache_imported(tmp_path):
+    (tmp_path / ".hbroot").write_text("")
+    (tmp_path / "hb.py").write_text(_top_hbpy)
+    (tmp_path / "lib").mkdir()
+    (tmp_path / "lib/hb.py").write_text(_import_lib_hbpy)
+    names = tmp_path / "lib/hbtest_names.py"
+    names.write_text('OUT = "x.txt"\n')
+    ninja = tmp_path / "build.ninja"
+    try:
+        context = hb.context(str(tmp_path))
+        context.generate()
+        assert str(names) in context._imported
+        # Modules are only imported once per process
+        del sys.modules["hbtest_names"]
+        names.write_text('OUT = "yy.txt"\n')
+        ninja.unlink()
+        context = hb.context(str(tmp_path))
+        context.generate()
+        assert context._evalcache.replayed == 0
+        assert "build b.txt: copy lib/yy.txt" in ninja.read_text()
+        ninja.unlink()
+        context = hb.context(str(tmp_path))
+        context.generate()
+        assert context._evalcache.replayed == 1
+        assert str(names) in context._imported
+    finally:
+        sys.modules.pop("hbtest_names", None)
+
+
+_loader_hbpy = """
+def build(hb):
+    import hb as hbmod
+
+    hbmod.read.load_and_run(hb, hb.root + "/rules/hb.py")
+    hb.copy("lib/@src", "b.txt")
+    hb.copy("other/other.txt", "c.txt")
+"""
+
+
+def test_evalcache_loaded_rules(tmp_path):
+    (tmp_path / ".hbroot").write_text("")
+    (tmp_path / "hb.py").write_text(_loader_hbpy)
+    (tmp_path / "rules").mkdir()
+    (tmp_path / "rules/hb.py").write_text(_rules_hbpy)
+    for name in ("lib", "other"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "hb.py").write_text(_lib_hbpy.format(name=name))
+    ninja = tmp_path / "build.ninja"
+    hb.context(str(tmp_path)).generate()
+    expected = ninja.read_text()
+    # The top hb.py file loads the rules, so it is not replayed
+    (tmp_path / "other/hb.py").write_text(
+        _lib_hbpy.format(name="other") + "#"
+    )
+    context = hb.context(str(tmp_path))
+    context.generate()
+    assert context._evalcache.executed == 3
+    assert context._evalcache.replayed == 1
+    assert ninja.read_text() == expected
+
+
+_chain_hbpy = """
+def build(hb):
+    hb.export("src", "x.txt", {next})
+"""
+
+
+def test_evalcache_export_chain(tmp_path):
+    count = 20
+    (tmp_path / ".hbroot").write_text("")
+    (tmp_path / "hb.py").write_text(_top_hbpy.replace("lib/", "d0/"))
+    for i in range(count):
+        (tmp_path / f"d{i}").mkdir()
+        next = f'"../d{i + 1}/@src"' if i + 1 < count else "()"
+        (tmp_path / f"d{i}/hb.py").write_text(_chain_hbpy.format(next=next))
+    ninja = tmp_path / "build.ninja"
+    hb.context(str(tmp_path)).generate()
+    expected = ninja.read_text()
+    with open(tmp_path / ".hb/evalcache.json") as fh:
+        pathsets = json.load(fh)["pathsets"]
+    # Exports are stored as their parts, not as copies of the paths
+    assert sum(len(p) for p in pathsets if isinstance(p, list)) == count
+    ninja.unlink()
+    context = hb.context(str(tmp_path))
+    context.generate()
+    assert context._evalcache.replayed == count
+    assert ninja.read_text() == expected
+
+
+def test_split(tmp_path):
+    (tmp_path / ".hbroot").write_text("")
+    (tmp_path / "hb.py").write_text(_top_hbpy)
+    (tmp_path / "lib").mkdir()
+    (tmp_path / "lib/hb.py").write_text(_lib_hbpy.format(name="x"))
+    ninja = tmp_path / "build.ninja"
+    subdir = tmp_path / ".hb/ninja"
+    (subdir).mkdir(parents=True)
+    (subdir / "stale.ninja").write_text("")
+    assert hb.context(str(tmp_path)).generate()
+    assert hb.context(str(tmp_path)).generate(split=True)
+    assert not hb.context(str(tmp_path)).generate(split=True)
+    top = ninja.read_text()
+    lib = _rule._subninja_name(str(tmp_path), f"{tmp_path}/lib")
+    assert "rule copy" in top
+    assert "subninja .hb/ninja/top.ninja" in top
+    assert f"subninja .hb/ninja/{lib}" in top
+    assert sorted(os.listdir(subdir)) == [lib, "top.ninja"]
+    assert "build b.txt: copy lib/x.txt" in (subdir / "top.ninja").read_text()
+    assert "build lib/x.txt:" in (subdir / lib).read_text()
+    # Subninja files are outputs of the generation
+    (subdir / lib).unlink()
+    assert hb.context(str(tmp_path)).generate(split=True)
+    assert "build lib/x.txt:" in (subdir / lib).read_text()
+    names = {_rule._subninja_name("/r", f"/r/{d}") for d in ("a/b", "a__b")}
+    assert len(names) == 2
+    context = hb.context(str(tmp_path))
+    hb.read.load_and_run(context, f"{tmp_path}/hb.py")
+    assert context.write_split(str(ninja)) == 0
+    (tmp_path / "lib/hb.py").write_text(_lib_hbpy.format(name="y"))
+    context = hb.context(str(tmp_path))
+    hb.read.load_and_run(context, f"{tmp_path}/hb.py")
+    assert context.write_split(str(ninja)) == 2
+
+
+def test_dep_groups(tmp_path):
+    (tmp_path / ".hbroot").write_text("")
+    context = hb.context(str(tmp_path))
+    headers = context.pathset([f"h{i}.h" for i in range(5)])
+
+    @context.rule("gcc -c $in -o $out")
+    def cc(*cfiles):
+        for cfile in cfiles:
+            context.build(cc, f"{cfile}.o", cfile, oodeps=headers)
+
+    cc("a.c", "b.c", "c.c")
+    fh = io.StringIO()
+    context.write_ninja(fh)
+    text = fh.getvalue()
+    lines = [line for line in text.split("\n") if "phony" in line]
+    assert len(lines) == 1
+    name = lines[0].split(":")[0][len("build ") :]
+    assert name.startswith("_hb_deps_")
+    assert lines[0].endswith("phony h0.h h1.h h2.h h3.h h4.h")
+    assert f"build a.c.o: cc a.c || {name}" in text
+    assert text.count(name) == 4
+    fh = io.StringIO()
+    context.write_ninja(fh, group=False)
+    assert "build a.c.o: cc a.c || h0.h h1.h h2.h h3.h h4.h" in fh.getvalue()
+
+
+_targets_hbpy = copy_hbpy(
+    'copy("lib1/x.txt", "out1")',
+    'copy("lib2/x.txt", "out2")',
+)
+
+_targets_lib_hbpy = """
+def build(hb):
+    hb.copy("a.txt", "x.txt")
+"""
+
+
+def test_targets(tmp_path):
+    (tmp_path / ".hbroot").write_text("")
+    (tmp_path / "hb.py").write_text(_targets_hbpy)
+    for lib in ("lib1", "lib2"):
+        (tmp_path / lib).mkdir()
+        (tmp_path / lib / "hb.py").write_text(_targets_lib_hbpy)
+    context = hb.context(str(tmp_path))
+    assert context.generate(targets=["out1"])
+    text = (tmp_path / "build.ninja").read_text()
+    assert "build out1: copy lib1/x.txt" in text
+    assert "build lib1/x.txt: copy lib1/a.txt" in text
+    assert "lib2" not in text
+    assert f"{tmp_path}/lib2/hb.py" not in context._loaded
+    assert not hb.context(str(tmp_path)).generate(targets=["out1"])
+    assert hb.context(str(tmp_path)).generate()
+    assert "build lib2/x.txt:" in (tmp_path / "build.ninja").read_text()
+    with pytest.raises(ValueError, match="No build for target out3"):
+        hb.context(str(tmp_path)).generate(targets=["out3"])
+    # Existing files are valid targets
+    assert hb.context(str(tmp_path)).generate(targets=["lib1/hb.py"])
+
+
+_deferred_hbpy = copy_hbpy(
+    'copy("lib/a.txt", "b.txt")',
+    'hb.lib_loaded = hasattr(hb, "lib")',
+)
+
+
+def test_deferred_scan(tmp_path):
+    (tmp_path / ".hbroot").write_text("")
+    (tmp_path / "hb.py").write_text(_deferred_hbpy)
+    (tmp_path / "lib").mkdir()
+    (tmp_path / "lib/hb.py").write_text("def build(hb):\n    hb.lib = 1\n")
+    context = hb.context(str(tmp_path))
+    context.generate()
+    assert context.lib == 1
+    assert not context.lib_loaded
+    (tmp_path / "build.ninja").unlink()
+    context = hb.context(str(tmp_path))
+    context.generate()
+    assert context._evalcache.replayed == 1
+    assert context.lib == 1
+
+
+def test_deferred_scan_load_and_run(tmp_path):
+    (tmp_path / ".hbroot").write_text("")
+    (tmp_path / "hb.py").write_text(_deferred_hbpy)
+    (tmp_path / "lib").mkdir()
+    (tmp_path / "lib/hb.py").write_text("def build(hb):\n    hb.lib = 1\n")
+    context = hb.context(str(tmp_path))
+    hb.read.load_and_run(context, f"{tmp_path}/hb.py")
+    assert context.lib == 1
+    assert not context._pending
+
+
+def test_restat():
+    context = hb.context(_this)
+
+    @context.rule("gen $in > $out", restat=True)
+    def gen(dst, src):
+        context.build(gen, dst, src)
+
+    gen("gen.txt", "gen.in")
+    fh = io.StringIO()
+    context.write_ninja(fh)
+    text = fh.getvalue()
+    assert "  restat = 1\n" in text
+    assert "  rspfile = ${gen_rspfile}\n" in text
+    assert "  rspfile_content = gen $in > $out\n" in text
+    assert "  gen_rspfile = .hb/gen.txt.cmd\n" in text